@@ -1,6 +1,9 @@
+import os
 import streamlit as st
-from rag import RAG_from_scratch, establish_connection, DateStandardizer
-import time
+from rag import (
+    RAG_from_scratch, SessionPool, DateStandardizer, IngestionQueue, create_evaluator, create_search_executor,
+)
+from tracing import tracer
 
 def local_css():
     st.markdown("""
@@ -155,21 +158,102 @@ def typing_indicator():
     """
     return st.markdown(typing_html, unsafe_allow_html=True)
 
+def clear_on_first_chunk(stream, typing_container):
+    """Pass a response stream through, removing the typing indicator once the first chunk arrives"""
+    for i, chunk in enumerate(stream):
+        if i == 0:
+            typing_container.empty()
+        yield chunk
+
+SAVING_STATUSES = ("queued", "standardized")
+MEMORY_STATUS_POLL_SECONDS = float(os.getenv("MEMEX_MEMORY_STATUS_POLL_SECONDS", "1"))
+
+STATUS_ICONS = {"queued": "⏳", "standardized": "⏳", "committed": "✅", "duplicate": "🔁", "failed": "❌"}
+
+def show_memory_status(status):
+    """Show the storage status of the most recently shared memory"""
+    if status["status"] == "committed":
+        st.success("Memory saved successfully!")
+    elif status["status"] == "duplicate":
+        st.info("You've already shared this memory, so it wasn't saved again.")
+    elif status["status"] == "failed":
+        st.error("Failed to save memory. Please try again.")
+    else:
+        st.info("Saving memory...")
+
+def memory_statuses(count):
+    """(text, status) of the last count memories shared in this browser session"""
+    ingestion_queue = get_ingestion_queue()
+    return [(text, ingestion_queue.status(ticket)) for ticket, text in st.session_state.memory_tickets[-count:]]
+
+def saving_in_progress():
+    return any(status["status"] in SAVING_STATUSES for _, status in memory_statuses(5))
+
+def latest_memory_status(polling):
+    """Status of the last shared memory; while polling, a full rerun once every memory is saved stops the timer"""
+    statuses = memory_statuses(1)
+    if statuses:
+        show_memory_status(statuses[0][1])
+    if polling and not saving_in_progress():
+        st.rerun()
+
+def recent_memories_status():
+    if len(st.session_state.memory_tickets) > 1:
+        with st.expander("Recently shared memories"):
+            for text, status in reversed(memory_statuses(5)):
+                preview = text if len(text) <= 60 else text[:57] + "..."
+                st.markdown(f"{STATUS_ICONS.get(status['status'], '')} {preview} — *{status['status']}*")
+
 def clear_on_success():
     if 'text_key' not in st.session_state:
         st.session_state.text_key = 0
     st.session_state.text_key += 1
 
-def initialize_session():
-    """Initialize Snowflake session and RAG instance if not already in session state"""
-    if 'snowflake_session' not in st.session_state:
-        st.session_state.snowflake_session = establish_connection()
-    
+@st.cache_resource
+def get_session_pool():
+    """One Snowpark session pool shared by every browser session of this app process"""
+    return SessionPool(
+        max_size=int(os.getenv("MEMEX_SESSION_POOL_SIZE", "4")),
+        health_check_interval=float(os.getenv("MEMEX_SESSION_HEALTH_CHECK_INTERVAL", "300")),
+    )
+
+@st.cache_resource
+def get_ingestion_queue():
+    """
+    One ingestion worker shared by every browser session; each memory is written through its session's
+    RAG on a session the worker leases itself
+    """
+    return IngestionQueue(pool=get_session_pool())
+
+@st.cache_resource
+def get_search_executor():
+    """One search thread pool shared by every browser session"""
+    return create_search_executor(max_workers=int(os.getenv("MEMEX_SEARCH_WORKERS", "8")))
+
+@st.cache_resource
+def get_evaluator():
+    """One background evaluator for every browser session in sampled-async mode, on a pool session of its own"""
+    if os.getenv("MEMEX_EVALUATION_MODE", "inline") != "sampled-async":
+        return None
+    return create_evaluator(get_session_pool().lease())
+
+def initialize_session(session):
+    """Point the RAG instance at the session leased for this script run, creating it if not already in session state"""
     if 'rag' not in st.session_state:
-        st.session_state.rag = RAG_from_scratch(st.session_state.snowflake_session)
-        
+        st.session_state.rag = RAG_from_scratch(
+            session, evaluator=get_evaluator(), search_executor=get_search_executor(),
+            session_pool=get_session_pool(),
+        )
+    else:
+        st.session_state.rag.set_session(session)
+
     if 'date_standardizer' not in st.session_state:
-        st.session_state.date_standardizer = DateStandardizer(st.session_state.snowflake_session)
+        st.session_state.date_standardizer = DateStandardizer(session)
+    else:
+        st.session_state.date_standardizer.session = session
+
+    if 'memory_tickets' not in st.session_state:
+        st.session_state.memory_tickets = []
 
 
 def main():
@@ -180,9 +264,6 @@ def main():
     )
     
     local_css()
-    
-    # Initialize session and RAG
-    initialize_session()
 
     # Sidebar with refined styling
     with st.sidebar:
@@ -201,18 +282,30 @@ def main():
 
         with st.expander("⚡ Read Before Chatting"):
             st.markdown("""
-            After storing a new memory, please wait 1 minute before querying it in Chat Mode. 
-            The cortex search service needs to get updated for your new content.
-            
-            You can continue to interact with your previously stored memories during this time.
+            Memories you store in this session can be asked about right away in Chat Mode.
+            The cortex search service takes about a minute to index new content, so until then
+            memex also searches your most recent memories locally.
             """)
 
+    # Lease a Snowflake session for this run and initialize the RAG once the page chrome is on screen.
+    # The session is released when the run ends, so a closed browser tab doesn't keep its lease.
+    session = None
+    try:
+        # prefer the session this browser session's RAG already uses, so its caches stay valid
+        current = st.session_state.rag.session if 'rag' in st.session_state else None
+        session = get_session_pool().lease(prefer=current)
+        initialize_session(session)
+        show_mode(mode)
+    finally:
+        if session is not None:
+            get_session_pool().release(session)
+
+
+def show_mode(mode):
+    """Main content area: the memory storage page, or the chat page when mode is on"""
     if 'messages' not in st.session_state:
         st.session_state.messages = []
 
-    if 'show_success' not in st.session_state:
-        st.session_state.show_success = False
-
     # Main content area
     if not mode:  # Memory Storage Mode
         st.markdown('<div class="content-container">', unsafe_allow_html=True)
@@ -231,22 +324,23 @@ def main():
         with col2:
             if st.button(" Tell memex"):
                 if new_info:
-                    with st.spinner("Saving..."):
-                        success = st.session_state.rag.inject_information(new_info)
-                        if success:
-                            st.session_state.show_success = True
-                        else:
-                            st.error("Failed to save memory. Please try again.")
+                    ticket = get_ingestion_queue().submit(new_info, st.session_state.rag)
+                    if ticket is None:
+                        st.error("memex is still saving earlier memories. Please try again in a moment.")
+                    else:
+                        st.session_state.memory_tickets.append((ticket, new_info))
+                        clear_on_success()
+                        st.rerun()
                 else:
                     st.warning("Please enter a memory to save.")
         
+        # the worker saves memories after this run ends, so rerun the status panels on a timer until it's done
+        polling = saving_in_progress()
+        run_every = MEMORY_STATUS_POLL_SECONDS if polling else None
         with col3:
-            if st.session_state.show_success:
-                st.success("Memory saved successfully!")
-                time.sleep(0.85)  
-                st.session_state.show_success = False  
-                clear_on_success()
-                st.rerun()  
+            st.fragment(latest_memory_status, run_every=run_every)(polling)
+
+        st.fragment(recent_memories_status, run_every=run_every)()
 
         st.markdown('</div>', unsafe_allow_html=True)
     
@@ -274,9 +368,10 @@ def main():
                     unsafe_allow_html=True
                 )
                 
-                response = st.session_state.rag.query(prompt)
-                
-                typing_container.markdown(response)
+                with tracer.span("chat_turn"):
+                    stream = clear_on_first_chunk(st.session_state.rag.query_stream(prompt, st.session_state.messages[:-1]), typing_container)
+                    response = st.write_stream(stream)
+                typing_container.empty()
                 st.session_state.messages.append({"role": "assistant", "content": response})
 
 if __name__ == "__main__":
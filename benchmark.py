@@ -0,0 +1,318 @@
+import argparse
+import json
+import math
+import random
+import re
+import statistics
+import os
+import subprocess
+import tempfile
+import time
+import types
+from datetime import datetime
+
+import rag
+from rag import RAG_from_scratch
+
+SAMPLE_MEMORIES = [
+    "Yesterday I went hiking with Sam at Rocky Ridge and we saw a family of deer.",
+    "Had dinner with mom and dad for Christmas, we made dumplings together.",
+    "Idea for the snowflake hackathon: a personal memory companion built on Cortex Search.",
+    "Started reading a book about the history of mathematics, the chapter on Euler was great.",
+    "Meeting with the landlord next Monday about fixing the kitchen sink.",
+    "Went to the dentist, no cavities this time.",
+    "Ran my first 10k in 52 minutes, legs were sore afterwards.",
+    "Lunch with Priya, she is moving to Berlin in the spring.",
+]
+SAMPLE_QUERIES = [
+    "how was my christmas?",
+    "what did I do yesterday?",
+    "any ideas I had for the snowflake hackathon",
+    "when is the meeting with the landlord?",
+    "what did I do last weekend?",
+    "who is moving to Berlin?",
+    "how fast did I run the 10k?",
+    "what book am I reading?",
+]
+STAGES = ["standardize_ms", "search_ms", "filter_ms", "generate_ms", "query_ms", "inject_ms"]
+
+
+class LatencyModel:
+    """Samples simulated latencies in milliseconds: constant, uniform or lognormal around a median."""
+    def __init__(self, median_ms: float, kind: str = "lognormal", spread: float = 0.35, seed: int = None):
+        self.median_ms = median_ms
+        self.kind = kind
+        self.spread = spread
+        self._random = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.kind == "constant":
+            return self.median_ms
+        if self.kind == "uniform":
+            return self._random.uniform(self.median_ms * (1 - self.spread), self.median_ms * (1 + self.spread))
+        return self._random.lognormvariate(0, self.spread) * self.median_ms
+
+    def wait(self):
+        time.sleep(self.sample() / 1000)
+
+
+class FakeComplete:
+    """Stand-in for snowflake.cortex.Complete that answers each memex prompt type plausibly."""
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, model, prompt, session=None, stream=False):
+        self.calls += 1
+        self.latency.wait()
+        original = re.search(r'Original (?:query|text): "(.*)"', prompt, re.DOTALL)
+        if original:
+            response = original.group(1)
+        elif "JSON array with exactly" in prompt:
+            count = int(re.search(r"exactly (\d+) integers", prompt).group(1))
+            response = json.dumps([7] * count)
+        else:
+            response = "Oh yes, I remember when you told me about that. It sounded like a lovely day."
+        if stream:
+            return iter(re.findall(r"\S+\s*", response))
+        return response
+
+
+class FakeSearchService:
+    """Stand-in for a Cortex Search service ranking an in-memory corpus by word overlap."""
+    def __init__(self, corpus: list, latency: LatencyModel):
+        self.corpus = corpus
+        self.latency = latency
+
+    def search(self, query, columns, limit, **kwargs):
+        self.latency.wait()
+        words = set(re.findall(r"\w+", query.lower()))
+        ranked = sorted(
+            self.corpus,
+            key=lambda text: len(words & set(re.findall(r"\w+", text.lower()))),
+            reverse=True,
+        )
+        return types.SimpleNamespace(results=[
+            {"ID": self.corpus.index(text) + 1, "TEXT_CONTENT": text} for text in ranked[:limit]
+        ])
+
+
+class FakeRoot:
+    """Stand-in for snowflake.core.Root resolving every service path to one FakeSearchService."""
+    def __init__(self, service: FakeSearchService):
+        self._service = service
+
+    def __call__(self, session):
+        return self
+
+    def __getitem__(self, name):
+        return self
+
+    @property
+    def databases(self):
+        return self
+
+    @property
+    def schemas(self):
+        return self
+
+    @property
+    def cortex_search_services(self):
+        return self
+
+    def search(self, *args, **kwargs):
+        return self._service.search(*args, **kwargs)
+
+
+class FakeSession:
+    """Stand-in for a Snowpark session: INSERT appends to the corpus, every statement takes sql latency."""
+    session_id = "benchmark"
+
+    def __init__(self, corpus: list, latency: LatencyModel):
+        self.corpus = corpus
+        self.latency = latency
+
+    def sql(self, query, params=None):
+        self.latency.wait()
+        if query.strip().upper().startswith("INSERT") and params:
+            # params are flattened rows; TEXT_CONTENT is the first of each row's values
+            row_width = query.count("?") // query.count("(?")
+            self.corpus.extend(params[::row_width])
+        return self
+
+    def collect(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeProvider:
+    """Stand-in for the TruLens Cortex provider's feedback functions."""
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+
+    def context_relevance(self, question, context, *args, **kwargs):
+        self.latency.wait()
+        words = set(re.findall(r"\w+", question.lower()))
+        overlap = len(words & set(re.findall(r"\w+", context.lower())))
+        return min(1.0, overlap / 3)
+
+    def relevance(self, prompt, response, *args, **kwargs):
+        self.latency.wait()
+        return 0.8
+
+    def groundedness_measure_with_cot_reasons(self, source, statement, *args, **kwargs):
+        self.latency.wait()
+        return 0.9, {}
+
+
+def install_fakes(complete_ms=800, search_ms=150, grade_ms=500, sql_ms=80, kind="lognormal", seed=0, corpus=None):
+    """Swap the Cortex Complete and Search backends used by rag.py for local stand-ins. Returns a fake session."""
+    corpus = list(SAMPLE_MEMORIES if corpus is None else corpus)
+    rag.Complete = FakeComplete(LatencyModel(complete_ms, kind, seed=seed))
+    rag.Root = FakeRoot(FakeSearchService(corpus, LatencyModel(search_ms, kind, seed=seed + 1)))
+    session = FakeSession(corpus, LatencyModel(sql_ms, kind, seed=seed + 2))
+    session.provider = FakeProvider(LatencyModel(grade_ms, kind, seed=seed + 3))
+    rag.create_provider = lambda session: session.provider
+    return session
+
+
+def build_rag(session, **rag_options):
+    """Create a RAG_from_scratch wired to the fake provider installed by install_fakes."""
+    memex = RAG_from_scratch(session, **rag_options)
+    if memex.context_filter is not None:
+        memex.context_filter.feedback = session.provider.context_relevance
+    return memex
+
+
+def build_local_index(memex, corpus: list):
+    """Load the fake corpus into the local index of a RAG_from_scratch using the local retriever."""
+    memex.retriever.index.add([
+        {"ID": i + 1, "TEXT_CONTENT": text, "EVENT_DATES": rag.extract_event_dates(text)}
+        for i, text in enumerate(corpus)
+    ])
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples: dict) -> dict:
+    summary = {}
+    for stage, values in samples.items():
+        if not values:
+            continue
+        summary[stage] = {
+            "count": len(values),
+            "mean": statistics.fmean(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+        }
+    return summary
+
+
+def run_benchmark(memex, queries: int, injects: int, seed: int = 0) -> dict:
+    chooser = random.Random(seed)
+    samples = {stage: [] for stage in STAGES}
+
+    for _ in range(injects):
+        started = time.perf_counter()
+        memex.inject_information(chooser.choice(SAMPLE_MEMORIES))
+        samples["inject_ms"].append((time.perf_counter() - started) * 1000)
+
+    for _ in range(queries):
+        started = time.perf_counter()
+        memex.query(chooser.choice(SAMPLE_QUERIES))
+        samples["query_ms"].append((time.perf_counter() - started) * 1000)
+        for stage in ("standardize_ms", "search_ms", "filter_ms", "generate_ms"):
+            if stage in memex.last_timings:
+                samples[stage].append(memex.last_timings[stage])
+    return summarize(samples)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_report(stages: dict, baseline: dict = None):
+    print(f"{'stage':<16}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, stats in stages.items():
+        line = f"{stage:<16}{stats['count']:>7}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}"
+        previous = (baseline or {}).get(stage)
+        if previous:
+            change = (stats["p50"] - previous["p50"]) / previous["p50"] * 100 if previous["p50"] else 0.0
+            line += f"   p50 {change:+.1f}% vs baseline"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency benchmark for memex with simulated Cortex backends")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--injects", type=int, default=20)
+    parser.add_argument("--complete-ms", type=float, default=800, help="median Complete latency")
+    parser.add_argument("--search-ms", type=float, default=150, help="median Cortex Search latency")
+    parser.add_argument("--grade-ms", type=float, default=500, help="median context relevance grading latency")
+    parser.add_argument("--sql-ms", type=float, default=80, help="median latency per SQL statement")
+    parser.add_argument("--latency", choices=["lognormal", "uniform", "constant"], default="lognormal")
+    parser.add_argument("--filter-mode", choices=["parallel", "batched"], default="parallel")
+    parser.add_argument("--cache", action="store_true", help="enable the answer cache")
+    parser.add_argument("--speculative", action="store_true", help="enable speculative search")
+    parser.add_argument("--multi-query", action="store_true", help="enable multi-query retrieval with rank fusion")
+    parser.add_argument("--dedup-policy", choices=["skip", "merge", "keep"], default="keep",
+                        help="the sample memories repeat, so only keep stores every inject")
+    parser.add_argument("--retriever", choices=["cortex", "local"], default="cortex",
+                        help="search the fake Cortex service or a local index of the same corpus")
+    parser.add_argument("--evaluation-mode", choices=["inline", "sampled-async", "off"], default="inline")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    session = install_fakes(args.complete_ms, args.search_ms, args.grade_ms, args.sql_ms, args.latency, args.seed)
+    if args.retriever == "local":
+        os.environ["MEMEX_LOCAL_INDEX_DIR"] = tempfile.mkdtemp(prefix="memex-benchmark-")
+        # the fake table has no IDs to sync from; build_local_index loads the corpus directly
+        os.environ["MEMEX_LOCAL_INDEX_SYNC_INTERVAL"] = "0"
+    memex = build_rag(
+        session,
+        retriever_backend=args.retriever,
+        dedup_policy=args.dedup_policy,
+        filter_mode=args.filter_mode,
+        cache_answers=args.cache,
+        speculative_search=args.speculative,
+        multi_query=args.multi_query,
+        evaluation_mode=args.evaluation_mode,
+    )
+    if args.retriever == "local":
+        build_local_index(memex, session.corpus)
+    stages = run_benchmark(memex, args.queries, args.injects, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["stages"]
+    print_report(stages, baseline)
+    print(f"Date standardization: {memex.date_standardizer.get_stats()}")
+    print(f"Context assembly: {memex.context_assembler.get_stats()}")
+
+    if args.output:
+        result = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "config": vars(args),
+            "stages": stages,
+            "complete_calls": rag.Complete.calls,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == "__main__":
+    main()
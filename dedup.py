@@ -0,0 +1,102 @@
+import hashlib
+import random
+import re
+import threading
+
+DEDUP_POLICIES = ("skip", "merge", "keep")
+
+NUM_PERMUTATIONS = 64
+_PRIME = (1 << 61) - 1
+_random = random.Random(1)  # fixed seed: signatures are stored and must stay comparable
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+# Every chunk of a stored memory carries this line, so it is removed wherever it appears
+_CONVERSATION_SUFFIX = re.compile(r"\(conversation happened on [^)]*\)", re.IGNORECASE)
+
+
+def normalize(text: str) -> str:
+    """Lowercased words of a memory without punctuation, whitespace or the conversation date"""
+    return " ".join(re.findall(r"\w+", _CONVERSATION_SUFFIX.sub(" ", text).lower()))
+
+
+def minhash(words: set) -> list:
+    """MinHash of a word set; the share of equal positions estimates the Jaccard similarity"""
+    hashes = [int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "big")
+              for word in words] or [0]
+    return [min((a * h + b) % _PRIME for h in hashes) & 0xFFFFFFFF for a, b in _PERMUTATIONS]
+
+
+def content_signature(text: str):
+    """(content hash, MinHash as hex) of a memory"""
+    normalized = normalize(text)
+    content_hash = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+    return content_hash, "".join(f"{value:08x}" for value in minhash(set(normalized.split())))
+
+
+def written_on(created_at) -> str:
+    """YYYY-MM-DD of a CREATED_AT timestamp or its string form"""
+    return str(created_at)[:10]
+
+
+def parse_minhash(signature: str) -> list:
+    return [int(signature[i:i + 8], 16) for i in range(0, len(signature), 8)]
+
+
+class DuplicateIndex:
+    """
+    Signatures of stored memories by entry. Exact duplicates are found by content hash, near
+    duplicates by estimated word Jaccard similarity >= threshold. MinHash values are grouped into
+    bands (locality-sensitive hashing), so only memories sharing a band are compared.
+    Only memories written on the same day are compared: the same text logged on another day
+    describes another event, e.g. a weekly gym visit.
+    """
+    def __init__(self, threshold: float = 0.85, bands: int = 16):
+        self.threshold = threshold
+        self.bands = bands
+        self._rows = NUM_PERMUTATIONS // bands
+        self._hashes = {}  # (day, content hash) -> entry id
+        self._signatures = {}  # entry id -> (day, content hash, minhash values)
+        self._buckets = {}  # (day, band, values) -> entry ids
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def _band_keys(self, day: str, values: list):
+        return [(day, band, tuple(values[band * self._rows:(band + 1) * self._rows])) for band in range(self.bands)]
+
+    def add(self, entry_id: str, content_hash: str, signature: str, day: str = None):
+        values = parse_minhash(signature)
+        with self._lock:
+            self._hashes.setdefault((day, content_hash), entry_id)
+            self._signatures[entry_id] = (day, content_hash, values)
+            for key in self._band_keys(day, values):
+                self._buckets.setdefault(key, set()).add(entry_id)
+
+    def remove(self, entry_id: str):
+        with self._lock:
+            stored = self._signatures.pop(entry_id, None)
+            if stored is None:
+                return
+            day, content_hash, values = stored
+            if self._hashes.get((day, content_hash)) == entry_id:
+                del self._hashes[(day, content_hash)]
+            for key in self._band_keys(day, values):
+                self._buckets.get(key, set()).discard(entry_id)
+
+    def find(self, content_hash: str, signature: str, day: str = None):
+        """("exact" or "near", entry id) of the closest duplicate written on day, or None"""
+        values = parse_minhash(signature)
+        with self._lock:
+            if (day, content_hash) in self._hashes:
+                return "exact", self._hashes[(day, content_hash)]
+            candidates = set()
+            for key in self._band_keys(day, values):
+                candidates |= self._buckets.get(key, set())
+            best = None
+            for entry_id in candidates:
+                stored = self._signatures[entry_id][2]
+                similarity = sum(a == b for a, b in zip(values, stored)) / NUM_PERMUTATIONS
+                if similarity >= self.threshold and (best is None or similarity > best[0]):
+                    best = (similarity, entry_id)
+        return ("near", best[1]) if best else None
@@ -0,0 +1,58 @@
+import argparse
+import json
+import time
+from rag import RAG_from_scratch, establish_connection
+
+def read_entries(path, fmt):
+    """Read memories from a file: blank-line separated paragraphs, one per line, or JSONL"""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+
+    if fmt == "lines":
+        entries = content.splitlines()
+    elif fmt == "jsonl":
+        entries = []
+        for line in content.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                entries.append(record["text"] if isinstance(record, dict) else record)
+    else:
+        entries = content.split("\n\n")
+
+    return [entry.strip() for entry in entries if entry.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load memories into TEXT_PARAGRAPHS_TABLE")
+    parser.add_argument("path", help="file containing the memories to import")
+    parser.add_argument("--format", choices=["paragraphs", "lines", "jsonl"], default="paragraphs")
+    parser.add_argument("--chunk-size", type=int, default=500, help="rows per INSERT/COMMIT")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent date standardizations")
+    parser.add_argument("--failures", help="write failed entries to this JSONL file")
+    args = parser.parse_args()
+
+    entries = read_entries(args.path, args.format)
+    print(f"Importing {len(entries)} memories from {args.path}")
+
+    session = establish_connection()
+    # the loader never answers questions, so skip the evaluator and answer cache
+    rag = RAG_from_scratch(session, evaluation_mode="off", cache_answers=False)
+    started = time.perf_counter()
+    results = rag.inject_many(entries, chunk_size=args.chunk_size, max_workers=args.workers)
+    elapsed = time.perf_counter() - started
+
+    failed = [r for r in results if not r["success"]]
+    duplicates = sum(1 for r in results if r["duplicate_of"])
+    print(f"Stored {len(results) - len(failed) - duplicates}/{len(results)} memories in {elapsed:.1f}s, "
+          f"skipped {duplicates} duplicates")
+    print(f"Date standardization: {rag.date_standardizer.get_stats()}")
+
+    if failed and args.failures:
+        with open(args.failures, "w", encoding="utf-8") as f:
+            for r in failed:
+                f.write(json.dumps({"text": entries[r["index"]], "error": r["error"]}) + "\n")
+        print(f"Wrote {len(failed)} failed entries to {args.failures}")
+
+    session.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime
+
+import rag
+from rag import IngestionQueue, SessionPool
+from benchmark import (
+    SAMPLE_MEMORIES, SAMPLE_QUERIES, FakeSession, LatencyModel, build_rag, git_revision, install_fakes, summarize,
+)
+
+TERMINAL_STATUSES = ("committed", "duplicate", "failed")
+
+
+class VirtualUser(threading.Thread):
+    """
+    One simulated browser session, holding what app.py keeps in st.session_state: a leased pool
+    session and its own RAG_from_scratch. Storage users submit to the IngestionQueue shared by all
+    users, like the app's. Chat users keep the conversation history like the app and start a new
+    conversation every few turns.
+    """
+    def __init__(self, name, kind, pool, make_rag, ingestion_queue, results, stop, think_ms=1000,
+                 turns_per_conversation=6, seed=0):
+        super().__init__(name=name, daemon=True)
+        self.kind = kind
+        self.pool = pool
+        self.make_rag = make_rag
+        self.ingestion_queue = ingestion_queue
+        self.results = results
+        self.stop = stop
+        self.think_ms = think_ms
+        self.turns_per_conversation = turns_per_conversation
+        self._random = random.Random(seed)
+        self._memories = itertools.count(1)
+
+    def run(self):
+        session = self.pool.lease()
+        try:
+            memex = self.make_rag(session)
+            history = []
+            while not self.stop.is_set():
+                if self.kind == "chat":
+                    history = self.chat(memex, history)
+                else:
+                    self.store(memex)
+                if self.think_ms:
+                    self.stop.wait(self._random.expovariate(1000 / self.think_ms))
+        except Exception as e:
+            print(f"{self.name} stopped: {e}")
+            self.results.record("setup", 0.0, False)
+        finally:
+            self.pool.release(session)
+
+    def chat(self, memex, history):
+        if len(history) >= 2 * self.turns_per_conversation:
+            history = []
+        prompt = self._random.choice(SAMPLE_QUERIES)
+        started = time.perf_counter()
+        first_token = None
+        chunks = []
+        try:
+            for chunk in memex.query_stream(prompt, history):
+                if first_token is None:
+                    first_token = (time.perf_counter() - started) * 1000
+                chunks.append(chunk)
+            ok = True
+        except Exception as e:
+            print(f"{self.name} chat failed: {e}")
+            ok = False
+        self.results.record("chat", (time.perf_counter() - started) * 1000, ok, first_token)
+        return history + [{"role": "user", "content": prompt}, {"role": "assistant", "content": "".join(chunks)}]
+
+    def store(self, memex):
+        # numbered so the dedup policy doesn't skip repeats of the sample memories
+        text = f"{self._random.choice(SAMPLE_MEMORIES)} (note {self.name}-{next(self._memories)})"
+        started = time.perf_counter()
+        ticket = self.ingestion_queue.submit(text, memex)
+        if ticket is None:
+            self.results.record("store", (time.perf_counter() - started) * 1000, False)
+            return
+        status = self.ingestion_queue.status(ticket)
+        while status["status"] not in TERMINAL_STATUSES and not self.stop.is_set():
+            time.sleep(0.01)
+            status = self.ingestion_queue.status(ticket)
+        if status["status"] in TERMINAL_STATUSES:
+            self.results.record("store", (time.perf_counter() - started) * 1000, status["status"] != "failed")
+
+
+class ConcurrencyLimit:
+    """Lets at most limit fake Complete calls run at once, like a capped Cortex or warehouse quota."""
+    def __init__(self, complete, limit: int):
+        self.complete = complete
+        self._slots = threading.BoundedSemaphore(limit)
+
+    @property
+    def calls(self):
+        return self.complete.calls
+
+    def __call__(self, *args, **kwargs):
+        with self._slots:
+            return self.complete(*args, **kwargs)
+
+
+class Results:
+    """Completed operations, attributed to the ramp stage they finished in."""
+    def __init__(self):
+        self.stage = 0
+        self._records = []
+        self._lock = threading.Lock()
+
+    def record(self, operation, latency_ms, ok, first_token_ms=None):
+        with self._lock:
+            self._records.append((self.stage, operation, latency_ms, ok, first_token_ms))
+
+    def for_stage(self, stage):
+        with self._lock:
+            return [record for record in self._records if record[0] == stage]
+
+
+def stage_report(records, elapsed, users, pool, complete_calls):
+    operations = {}
+    for _, operation, latency_ms, ok, first_token_ms in records:
+        stats = operations.setdefault(operation, {"ok": [], "errors": 0, "first_token": []})
+        if ok:
+            stats["ok"].append(latency_ms)
+            if first_token_ms is not None:
+                stats["first_token"].append(first_token_ms)
+        else:
+            stats["errors"] += 1
+
+    report = {"users": users, "seconds": elapsed, "operations": {}}
+    for operation, stats in operations.items():
+        total = len(stats["ok"]) + stats["errors"]
+        summary = summarize({"latency_ms": stats["ok"], "first_token_ms": stats["first_token"]})
+        report["operations"][operation] = {
+            "completed": total,
+            "throughput_per_s": total / elapsed if elapsed else 0.0,
+            "error_rate": stats["errors"] / total if total else 0.0,
+            **summary,
+        }
+    report["pool_sessions"] = pool.size()
+    report["pool_stats"] = dict(pool.stats)
+    if complete_calls is not None:
+        report["complete_calls_per_s"] = complete_calls / elapsed if elapsed else 0.0
+    return report
+
+
+def print_stage(report, baseline_p95=None):
+    print(f"\n{report['users']} users, {report['seconds']:.0f}s, {report['pool_sessions']} Snowflake sessions "
+          f"{report['pool_stats']}")
+    if "complete_calls_per_s" in report:
+        print(f"  Complete calls/s: {report['complete_calls_per_s']:.1f}")
+    print(f"  {'operation':<10}{'done':>6}{'ops/s':>8}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'ttft p95':>10}")
+    for operation, stats in report["operations"].items():
+        latency = stats.get("latency_ms", {})
+        first_token = stats.get("first_token_ms", {})
+        line = (f"  {operation:<10}{stats['completed']:>6}{stats['throughput_per_s']:>8.2f}"
+                f"{stats['error_rate']:>8.1%}{latency.get('p50', 0):>9.0f}{latency.get('p95', 0):>9.0f}"
+                f"{latency.get('p99', 0):>9.0f}{first_token.get('p95', 0):>10.0f}")
+        print(line)
+    chat = report["operations"].get("chat", {}).get("latency_ms")
+    if baseline_p95 and chat and chat["p95"] > 2 * baseline_p95:
+        print(f"  ! chat p95 is {chat['p95'] / baseline_p95:.1f}x the first stage: saturated")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent memex chat and storage users")
+    parser.add_argument("--backend", choices=["fake", "snowflake"], default="fake",
+                        help="simulated Cortex backends from benchmark.py, or the Snowflake account in .env")
+    parser.add_argument("--users", default="1,2,4,8,16", help="concurrent users at each ramp stage")
+    parser.add_argument("--stage-seconds", type=float, default=30)
+    parser.add_argument("--chat-ratio", type=float, default=0.8, help="share of users chatting; the rest store memories")
+    parser.add_argument("--think-ms", type=float, default=1000, help="mean pause between a user's requests")
+    parser.add_argument("--pool-size", type=int, default=4, help="Snowflake sessions shared by all users")
+    parser.add_argument("--evaluation-mode", choices=["inline", "sampled-async", "off"], default="inline")
+    parser.add_argument("--allow-writes", action="store_true",
+                        help="let storage users write test memories to the real table with --backend snowflake")
+    parser.add_argument("--complete-ms", type=float, default=800, help="median fake Complete latency")
+    parser.add_argument("--search-ms", type=float, default=150, help="median fake Cortex Search latency")
+    parser.add_argument("--grade-ms", type=float, default=500, help="median fake relevance grading latency")
+    parser.add_argument("--sql-ms", type=float, default=80, help="median fake latency per SQL statement")
+    parser.add_argument("--complete-concurrency", type=int, default=0,
+                        help="cap on concurrent fake Complete calls (0 for no cap)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    stages = [int(users) for users in args.users.split(",")]
+    if args.backend == "fake":
+        session = install_fakes(args.complete_ms, args.search_ms, args.grade_ms, args.sql_ms, seed=args.seed)
+        if args.complete_concurrency:
+            rag.Complete = ConcurrencyLimit(rag.Complete, args.complete_concurrency)
+
+        def new_session():
+            fake = FakeSession(session.corpus, LatencyModel(args.sql_ms, seed=random.randrange(1 << 30)))
+            fake.provider = session.provider
+            return fake
+
+        pool = SessionPool(max_size=args.pool_size, factory=new_session)
+        build = build_rag
+    else:
+        if args.chat_ratio < 1 and not args.allow_writes:
+            print("Storage users would write test memories to your table; using chat users only (see --allow-writes)")
+            args.chat_ratio = 1.0
+        pool = SessionPool(max_size=args.pool_size)
+        build = rag.RAG_from_scratch
+
+    # like the app, all users share one search pool and one background evaluator
+    search_executor = rag.create_search_executor()
+    evaluator_session = pool.lease() if args.evaluation_mode == "sampled-async" else None
+    evaluator = rag.create_evaluator(evaluator_session) if evaluator_session is not None else None
+    make_rag = lambda leased: build(leased, evaluation_mode=args.evaluation_mode,
+                                    evaluator=evaluator, search_executor=search_executor, session_pool=pool)
+
+    results = Results()
+    ingestion_queue = IngestionQueue(pool=pool)
+    stop = threading.Event()
+    users = []
+    reports = []
+    baseline_p95 = None
+    try:
+        for stage, target in enumerate(stages):
+            results.stage = stage
+            while len(users) < target:
+                kind = "chat" if len(users) < round(target * args.chat_ratio) else "store"
+                user = VirtualUser(f"user{len(users) + 1}", kind, pool, make_rag, ingestion_queue, results, stop,
+                                   think_ms=args.think_ms, seed=args.seed + len(users))
+                user.start()
+                users.append(user)
+            calls_before = getattr(rag.Complete, "calls", None)
+            started = time.perf_counter()
+            time.sleep(args.stage_seconds)
+            elapsed = time.perf_counter() - started
+            calls = getattr(rag.Complete, "calls", None)
+            report = stage_report(results.for_stage(stage), elapsed, len(users), pool,
+                                  calls - calls_before if calls is not None else None)
+            reports.append(report)
+            print_stage(report, baseline_p95)
+            chat = report["operations"].get("chat", {}).get("latency_ms")
+            if baseline_p95 is None and chat:
+                baseline_p95 = chat["p95"]
+    finally:
+        stop.set()
+        for user in users:
+            user.join(timeout=30)
+        search_executor.shutdown(wait=False)
+        pool.close()
+
+    if args.output:
+        result = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "config": vars(args),
+            "stages": reports,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == "__main__":
+    main()
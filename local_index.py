@@ -0,0 +1,436 @@
+import argparse
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: the in-process lock still keeps one app's sessions apart
+    fcntl = None
+
+from rag import Retriever, reciprocal_rank_fusion
+from tracing import tracer
+
+SYNC_QUERY = "SELECT ID, TEXT_CONTENT, EVENT_DATES FROM TEXT_PARAGRAPHS_TABLE WHERE ID > ? ORDER BY ID"
+DELETED_QUERY = "SELECT SEQ, ID FROM DELETED_MEMORIES WHERE SEQ > ? ORDER BY SEQ"
+
+
+def tokenize(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+
+def embed(text: str, dim: int = 512) -> np.ndarray:
+    """
+    Hashed bag-of-features embedding: words and character trigrams (so "hike" and "hiking" overlap)
+    are hashed into dim signed buckets and the vector is L2-normalized. Needs no model or network.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in tokenize(text):
+        features = [word] + [f"#{trigram}" for trigram in _trigrams(word)]
+        for feature in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _trigrams(word: str) -> list:
+    padded = f"<{word}>"
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+class LocalVectorIndex:
+    """
+    In-process memory index stored in index_dir:
+      vectors.f32    embeddings, one float32 row per memory, memory-mapped for search
+      records.jsonl  ID, TEXT_CONTENT and EVENT_DATES of each row, in the same order
+    Rows are appended in ID order, so syncing is "add everything after last_id"; removing rows
+    rewrites both files.
+    Search fuses a dense top-k over the embeddings with BM25 over an in-memory inverted index.
+    Writers hold an exclusive lock on index_dir/index.lock, so an app and a `sync` run from the
+    command line don't interleave their rows; use shared_index() for one copy per process.
+    """
+    def __init__(self, index_dir: str = "memex_index", dim: int = 512, k1: float = 1.5, b: float = 0.75):
+        self.index_dir = index_dir
+        self.dim = dim
+        self.k1 = k1
+        self.b = b
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.records_path = os.path.join(index_dir, "records.jsonl")
+        self.meta_path = os.path.join(index_dir, "index.json")
+        self.lock_path = os.path.join(index_dir, "index.lock")
+        self._lock = threading.Lock()
+        self.load()
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _stored_count(self):
+        if not os.path.exists(self.meta_path):
+            return 0
+        with open(self.meta_path, encoding="utf-8") as f:
+            return json.load(f)["count"]
+
+    def load(self):
+        with self._lock, self._file_lock():
+            self._load()
+
+    def _load(self):
+        self.records = []
+        self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self._postings = {}  # term -> {row: term frequency}
+        self._lengths = []
+        self._total_length = 0
+        self._array_cache = {}
+        self._length_array = None
+        self._dates = {}  # ISO date -> rows
+        self.deleted_seq = -1  # last DELETED_MEMORIES row applied
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.deleted_seq = meta.get("deleted_seq", -1)
+            with open(self.records_path, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            # the metadata is written last, so rows past its count are from an interrupted add
+            if len(records) > meta["count"]:
+                records = records[:meta["count"]]
+                with open(self.records_path, "w", encoding="utf-8") as f:
+                    f.writelines(json.dumps(record) + "\n" for record in records)
+            self._index_records(records)
+            self._map_vectors()
+
+    @property
+    def last_id(self):
+        return self.records[-1]["ID"] if self.records else None
+
+    def __len__(self):
+        return len(self.records)
+
+    def _map_vectors(self):
+        if self.records:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.records), self.dim))
+
+    def _index_records(self, records: list):
+        self._array_cache = {}
+        self._length_array = None
+        for record in records:
+            row = len(self.records)
+            self.records.append(record)
+            tokens = tokenize(record["TEXT_CONTENT"])
+            self._lengths.append(len(tokens))
+            self._total_length += len(tokens)
+            for term in set(tokens):
+                self._postings.setdefault(term, {})[row] = tokens.count(term)
+            for day in record.get("EVENT_DATES") or []:
+                self._dates.setdefault(day, []).append(row)
+
+    @staticmethod
+    def _after(records: list, last_id) -> list:
+        """Records with an ID above last_id, normalized to the stored fields."""
+        new = []
+        for record in records:
+            if last_id is not None and record["ID"] <= last_id:
+                continue
+            event_dates = record.get("EVENT_DATES") or []
+            if isinstance(event_dates, str):
+                event_dates = json.loads(event_dates)
+            new.append({"ID": record["ID"], "TEXT_CONTENT": record["TEXT_CONTENT"], "EVENT_DATES": event_dates})
+            last_id = record["ID"]
+        return new
+
+    def add(self, records: list) -> int:
+        """Append records with an ID above last_id. Returns how many were added."""
+        new = self._after(records, self.last_id)
+        if not new:
+            return 0
+        # embedding is the slow part; do it before taking the locks so searches aren't held up
+        vectors = {record["ID"]: embed(record["TEXT_CONTENT"], self.dim) for record in new}
+
+        with self._lock, self._file_lock():
+            if self._stored_count() != len(self.records):
+                # another process added rows since this copy was loaded
+                self._load()
+            new = self._after(new, self.last_id)
+            if not new:
+                return 0
+            # the vector file may hold rows of an interrupted add; overwrite from the last good row
+            mode = "r+b" if os.path.exists(self.vectors_path) else "wb"
+            with open(self.vectors_path, mode) as f:
+                f.seek(len(self.records) * self.dim * 4)
+                f.truncate()
+                f.write(np.stack([vectors[record["ID"]] for record in new]).tobytes())
+            with open(self.records_path, "a" if self.records else "w", encoding="utf-8") as f:
+                for record in new:
+                    f.write(json.dumps(record) + "\n")
+            self._index_records(new)
+            self._write_meta(len(self.records))
+            self._map_vectors()
+            return len(new)
+
+    def _write_meta(self, count: int):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "count": count, "last_id": self.records[count - 1]["ID"] if count else None,
+                       "deleted_seq": self.deleted_seq}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def remove(self, ids, deleted_seq: int = None) -> int:
+        """
+        Drop the records with these IDs, e.g. memories deleted from the table, and record
+        deleted_seq as the last DELETED_MEMORIES row applied. Returns how many were removed.
+        """
+        ids = set(ids)
+        with self._lock, self._file_lock():
+            if self._stored_count() != len(self.records):
+                self._load()
+            if deleted_seq is not None:
+                self.deleted_seq = max(self.deleted_seq, deleted_seq)
+            keep = [row for row, record in enumerate(self.records) if record["ID"] not in ids]
+            removed = len(self.records) - len(keep)
+            if not removed:
+                if deleted_seq is not None:
+                    self._write_meta(len(self.records))
+                return 0
+            records = [self.records[row] for row in keep]
+            vectors = np.asarray(self.vectors[keep]) if keep else np.zeros((0, self.dim), dtype=np.float32)
+            # an interruption from here on leaves an empty index, which the next sync rebuilds
+            self._write_meta(0)
+            with open(f"{self.vectors_path}.tmp", "wb") as f:
+                f.write(vectors.tobytes())
+            os.replace(f"{self.vectors_path}.tmp", self.vectors_path)
+            with open(f"{self.records_path}.tmp", "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+            os.replace(f"{self.records_path}.tmp", self.records_path)
+            self.records = records
+            self._write_meta(len(records))
+            self._load()
+            return removed
+
+    def _dense(self, query: str, rows, limit: int) -> list:
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        scores = vectors @ embed(query, self.dim)
+        top = np.argpartition(-scores, limit - 1)[:limit] if len(scores) > limit else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        candidates = top if rows is None else np.asarray(rows)[top]
+        return [int(row) for row, score in zip(candidates, scores[top]) if score > 0]
+
+    def _posting_arrays(self, term: str):
+        """(rows, term frequencies) of term as arrays, cached until the next add."""
+        arrays = self._array_cache.get(term)
+        if arrays is None:
+            postings = self._postings.get(term, {})
+            arrays = self._array_cache[term] = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float32, count=len(postings)),
+            )
+        return arrays
+
+    def _bm25(self, query: str, rows, limit: int) -> list:
+        count = len(self.records)
+        if self._length_array is None:
+            self._length_array = np.asarray(self._lengths, dtype=np.float32)
+        norms = self.k1 * (1 - self.b + self.b * self._length_array / ((self._total_length / count) or 1))
+        scores = np.zeros(count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            postings, frequencies = self._posting_arrays(term)
+            if not len(postings):
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            scores[postings] += idf * frequencies * (self.k1 + 1) / (frequencies + norms[postings])
+        if rows is not None:
+            mask = np.zeros(count, dtype=bool)
+            mask[rows] = True
+            scores[~mask] = 0
+        top = np.argpartition(-scores, limit - 1)[:limit] if count > limit else np.arange(count)
+        top = top[np.argsort(-scores[top])]
+        return [int(row) for row in top if scores[row] > 0]
+
+    def search(self, query: str, limit: int = 4, event_dates: list = None) -> list:
+        """Best matching records for query, restricted to memories about event_dates if given."""
+        with self._lock:
+            if not self.records:
+                return []
+            rows = None
+            if event_dates:
+                rows = sorted({row for day in event_dates for row in self._dates.get(day, [])})
+                if not rows:
+                    return []
+            depth = limit * 3
+            rankings = [
+                [self.records[row] for row in self._dense(query, rows, depth)],
+                [self.records[row] for row in self._bm25(query, rows, depth)],
+            ]
+        return reciprocal_rank_fusion(rankings)[:limit]
+
+
+class IndexSyncer:
+    """Pulls rows of TEXT_PARAGRAPHS_TABLE newer than an index into it, at most one sync at a time."""
+    def __init__(self, index: LocalVectorIndex):
+        self.index = index
+        self._last_sync = 0.0
+        self._sync_thread = None
+        self._lock = threading.Lock()
+
+    def sync(self, snowpark_session):
+        """
+        Add rows of TEXT_PARAGRAPHS_TABLE newer than the index and remove rows logged in
+        DELETED_MEMORIES since the last sync (replaced by the merge policy or cleaned up by
+        dedupe). Returns (added, removed).
+        """
+        last_id = self.index.last_id
+        rows = snowpark_session.sql(SYNC_QUERY, params=[last_id if last_id is not None else -1]).collect()
+        added = self.index.add([row.as_dict() for row in rows])
+        deleted = snowpark_session.sql(DELETED_QUERY, params=[self.index.deleted_seq]).collect()
+        removed = self.index.remove([row["ID"] for row in deleted], deleted[-1]["SEQ"]) if deleted else 0
+        return added, removed
+
+    def _sync_in_background(self, snowpark_session, session_pool=None):
+        try:
+            if session_pool is not None:
+                with session_pool.leased() as leased:
+                    added, removed = self.sync(leased)
+            else:
+                added, removed = self.sync(snowpark_session)
+            if added or removed:
+                print(f"Local index synced {added} new and {removed} deleted memories")
+        except Exception as e:
+            print(f"Error syncing local index: {e}")
+
+    def maybe_sync(self, snowpark_session, interval_seconds: float, session_pool=None):
+        """
+        Start a background sync if none is running and the last one is interval_seconds old.
+        It runs on a session leased from session_pool if given, else on snowpark_session.
+        """
+        if interval_seconds <= 0 or (snowpark_session is None and session_pool is None):
+            return
+        with self._lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                return
+            if time.monotonic() - self._last_sync < interval_seconds:
+                return
+            self._last_sync = time.monotonic()
+            self._sync_thread = threading.Thread(target=self._sync_in_background, args=(snowpark_session, session_pool),
+                                                 name="memex-index-sync", daemon=True)
+            self._sync_thread.start()
+
+
+_shared = {}  # absolute index_dir -> (LocalVectorIndex, IndexSyncer)
+_shared_lock = threading.Lock()
+
+
+def shared_index(index_dir: str = "memex_index"):
+    """The (index, syncer) of index_dir shared by every retriever in this process."""
+    key = os.path.abspath(index_dir)
+    with _shared_lock:
+        if key not in _shared:
+            index = LocalVectorIndex(index_dir)
+            _shared[key] = (index, IndexSyncer(index))
+        return _shared[key]
+
+
+class LocalIndexRetriever(Retriever):
+    """
+    Retriever over the LocalVectorIndex of index_dir, shared with every other retriever of this
+    process. Every sync_interval_seconds a search starts a background sync that pulls rows with a
+    higher ID from TEXT_PARAGRAPHS_TABLE; until then, memories written by this process are covered
+    by RAG_from_scratch.recent_writes. A zero interval disables syncing. With a session_pool the
+    sync leases its own session, as the app releases the one it passed in when a script run ends.
+    """
+    def __init__(self, snowpark_session, limit_to_retrieve: int = 4, index_dir: str = "memex_index",
+                 sync_interval_seconds: float = 60, session_pool=None):
+        super().__init__()
+        self._snowpark_session = snowpark_session
+        self._session_pool = session_pool
+        self._limit_to_retrieve = limit_to_retrieve
+        self.index, self.syncer = shared_index(index_dir)
+        self.sync_interval_seconds = sync_interval_seconds
+
+    def refresh(self, snowpark_session=None):
+        if snowpark_session is not None:
+            self._snowpark_session = snowpark_session
+
+    def sync(self):
+        """Bring the index up to date with TEXT_PARAGRAPHS_TABLE. Returns (added, removed)."""
+        return self.syncer.sync(self._snowpark_session)
+
+    def maybe_sync(self):
+        self.syncer.maybe_sync(self._snowpark_session, self.sync_interval_seconds, self._session_pool)
+
+    def retrieve_records(self, query: str, event_dates: list = None) -> list:
+        with tracer.span("search"):
+            self.maybe_sync()
+            started = time.perf_counter()
+            records = self.index.search(query, self._limit_to_retrieve, event_dates)
+            timings = {}
+            if event_dates:
+                timings["date_filter"] = "applied" if records else "fallback"
+                if not records:
+                    records = self.index.search(query, self._limit_to_retrieve)
+            timings["search_ms"] = (time.perf_counter() - started) * 1000
+            self.last_timings = timings
+            return records
+
+
+def read_export(path: str):
+    """Records of a JSONL export written by `python snowflake.py export`"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the local memex search index")
+    parser.add_argument("--index-dir", default=os.getenv("MEMEX_LOCAL_INDEX_DIR", "memex_index"))
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    sync_parser = subcommands.add_parser("sync", help="add memories newer than the index")
+    sync_parser.add_argument("export", nargs="?", help="JSONL export to read instead of querying Snowflake")
+    search_parser = subcommands.add_parser("search", help="search the index")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--limit", type=int, default=4)
+    args = parser.parse_args()
+
+    retriever = LocalIndexRetriever(None, index_dir=args.index_dir, sync_interval_seconds=0)
+    index = retriever.index
+    if args.command == "sync":
+        started = time.perf_counter()
+        removed = 0
+        if args.export:
+            added = index.add(list(read_export(args.export)))
+        else:
+            from rag import establish_connection
+            session = establish_connection()
+            try:
+                retriever.refresh(session)
+                added, removed = retriever.sync()
+            finally:
+                session.close()
+        print(f"Added {added} and removed {removed} memories in {time.perf_counter() - started:.1f}s; "
+              f"index has {len(index)} memories up to ID {index.last_id}")
+    else:
+        started = time.perf_counter()
+        results = index.search(args.query, args.limit)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for record in results:
+            print(f"[{record['ID']}] {record['TEXT_CONTENT']}")
+        print(f"{len(results)} results in {elapsed_ms:.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -3,22 +3,30 @@ from snowflake.cortex import Complete
 from snowflake.core import Root
 from dotenv import load_dotenv
 from typing import List
-from datetime import datetime
-from trulens.core import TruSession
-from trulens.connectors.snowflake import SnowflakeConnector
-from trulens.apps.custom import instrument
-from trulens.core.guardrails.base import context_filter
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
 import os
-from trulens.providers.cortex.provider import Cortex
-from trulens.core import Feedback
-from trulens.core import Select
-import numpy as np
-from trulens.core import TruSession
-from trulens.connectors.snowflake import SnowflakeConnector
+import re
+import json
+import time
+import calendar
+import contextvars
+import threading
+import queue
+import itertools
+import random
+import hashlib
+import uuid
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from tracing import tracer
+from dedup import DEDUP_POLICIES, DuplicateIndex, content_signature, written_on
 
 load_dotenv()
 
-def establish_connection():
+def establish_connection(keep_alive: bool = False):
     connection_parameters = {
         "account": os.getenv("SNOWFLAKE_ACCOUNT"),
         "user": os.getenv("SNOWFLAKE_USER"),
@@ -28,18 +36,520 @@ def establish_connection():
         "schema": os.getenv("SNOWFLAKE_SCHEMA"),
         "role": os.getenv("SNOWFLAKE_ROLE"),
     }
+    if keep_alive:
+        connection_parameters["client_session_keep_alive"] = True
 
     snowpark_session = Session.builder.configs(connection_parameters).create()
     return snowpark_session
 
+
+class SessionPool:
+    """
+    Process-wide pool of Snowpark sessions shared by all app users.
+    Snowpark sessions can run queries from several threads, so users are spread over at most
+    max_size sessions: a new session is only created when every existing one is leased.
+    Idle sessions are health checked with SELECT 1 before being handed out again and replaced
+    when the check fails; the connections themselves are kept alive by the driver.
+    """
+    def __init__(self, max_size: int = 4, health_check_interval: float = 300, factory=None):
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.factory = factory or (lambda: establish_connection(keep_alive=True))
+        self._sessions = []  # [session, lease count, last checked]
+        self._replaced = {}  # id(old session) -> (old session, replacement)
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)  # notified when a reserved session is created or dropped
+        self.stats = {"created": 0, "replaced": 0, "health_checks": 0}
+
+    def lease(self, prefer=None):
+        """
+        Hand out prefer if it is still in the pool (or its replacement), so a caller keeps the session
+        its caches were built for; otherwise the least leased session, creating one if all are busy
+        and there is room.
+        """
+        with self._ready:
+            prefer = self._current(prefer)
+            entry = next((e for e in self._sessions if prefer is not None and e[0] is prefer), None)
+            if entry is not None:
+                entry[1] += 1
+                session = entry[0]
+            while entry is None:
+                ready = [entry for entry in self._sessions if entry[0] is not None]
+                if not any(entry[1] == 0 for entry in ready) and len(self._sessions) < self.max_size:
+                    # reserve the slot; the session is created outside the lock
+                    entry = [None, 1, time.monotonic()]
+                    self._sessions.append(entry)
+                    session = None
+                elif ready:
+                    entry = min(ready, key=lambda e: e[1])
+                    entry[1] += 1
+                    session = entry[0]
+                else:
+                    # every slot is taken by a session still being created
+                    self._ready.wait()
+        if session is not None:
+            try:
+                return self.ensure_healthy(session)
+            except Exception:
+                # no working session to hand out; give the lease back
+                self.release(session)
+                raise
+
+        try:
+            session = self.factory()
+        except Exception:
+            with self._ready:
+                self._sessions.remove(entry)
+                self._ready.notify_all()
+            raise
+        with self._ready:
+            entry[0] = session
+            self.stats["created"] += 1
+            self._ready.notify_all()
+        return session
+
+    @contextmanager
+    def leased(self, prefer=None):
+        """Lease a session for the duration of a with block."""
+        session = self.lease(prefer)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def _current(self, session):
+        """session, or the session that replaced it. Call with the lock held."""
+        while id(session) in self._replaced and self._replaced[id(session)][0] is session:
+            session = self._replaced[id(session)][1]
+        return session
+
+    def check_before_next_lease(self, session):
+        """Health check session the next time it is leased, e.g. after a connection error."""
+        with self._lock:
+            session = self._current(session)
+            for entry in self._sessions:
+                if entry[0] is session:
+                    entry[2] = float("-inf")
+
+    def release(self, session):
+        with self._lock:
+            for entry in self._sessions:
+                if entry[0] is session:
+                    entry[1] = max(0, entry[1] - 1)
+
+    def _is_healthy(self, session) -> bool:
+        try:
+            session.sql("SELECT 1").collect()
+            return True
+        except Exception as e:
+            print(f"Snowflake session failed health check: {e}")
+            return False
+
+    def ensure_healthy(self, session):
+        """Return session if it still works (checked at most every health_check_interval), else its replacement."""
+        with self._lock:
+            session = self._current(session)
+            entry = next((e for e in self._sessions if e[0] is session), None)
+            if entry is None or time.monotonic() - entry[2] < self.health_check_interval:
+                return session
+            last_checked, entry[2] = entry[2], time.monotonic()
+            self.stats["health_checks"] += 1
+        if self._is_healthy(session):
+            return session
+
+        try:
+            replacement = self.factory()
+        except Exception:
+            with self._lock:
+                # keep the failed session due for a check, so it isn't handed out unchecked meanwhile
+                entry[2] = last_checked
+            raise
+        with self._lock:
+            entry[0] = replacement
+            entry[2] = time.monotonic()
+            self._replaced[id(session)] = (session, replacement)
+            self.stats["replaced"] += 1
+        try:
+            session.close()
+        except Exception:
+            pass
+        return replacement
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+            self._replaced.clear()
+        for session, _, _ in sessions:
+            if session is None:
+                continue
+            try:
+                session.close()
+            except Exception as e:
+                print(f"Error closing Snowflake session: {e}")
+
+
+def create_provider(session):
+    """Build the TruLens Cortex feedback provider. trulens is imported here because it is slow to import."""
+    from trulens.providers.cortex.provider import Cortex
+    return Cortex(
+        session,
+        model_engine="mistral-large2",
+    )
+
+
+# Methods recorded by TruLens; registered lazily by enable_trulens_instrumentation
+INSTRUMENTED_METHODS = [
+    "retrieve_context_with_filter", "generate_completion", "record_streamed_completion", "query", "answer_stream",
+]
+_trulens_instrumented = False
+
+
+def enable_trulens_instrumentation():
+    """Register RAG_from_scratch's methods with TruLens, the equivalent of decorating them with @instrument."""
+    global _trulens_instrumented
+    if _trulens_instrumented:
+        return
+    from trulens.apps.custom import instrument
+    for name in INSTRUMENTED_METHODS:
+        instrument.method(RAG_from_scratch, name)
+    _trulens_instrumented = True
+
+# Relative-date vocabulary understood by the local resolver in DateStandardizer.
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+MONTHS = ["january", "february", "march", "april", "may", "june", "july",
+          "august", "september", "october", "november", "december"]
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12,
+}
+HOLIDAYS = {
+    "christmas eve": (12, 24),
+    "christmas": (12, 25),
+    "new year's eve": (12, 31),
+    "new year's day": (1, 1),
+    "halloween": (10, 31),
+    "valentine's day": (2, 14),
+}
+
+# Month names that are also ordinary words
+_MONTH_WORDS_AMBIGUOUS = {"may", "march"}
+
+_WEEKDAY_RE = "|".join(WEEKDAYS)
+_MONTH_RE = "|".join(MONTHS)
+_NUMBER_RE = r"\d+|" + "|".join(NUMBER_WORDS)
+_HOLIDAY_RE = "|".join(
+    name.replace("'", "['’]?").replace(" ", r"\s+") for name in HOLIDAYS
+)
+
+# Phrasing the local resolver should not guess at; these go to the LLM.
+AMBIGUOUS_DATE_PATTERN = re.compile(
+    r"\b(weekends?|recently|lately|the other day|a few|a couple|couple of|several|"
+    r"a while|soon|fortnight|this past|the coming|upcoming|"
+    # "in two days" is a date in "I leave in two days" but a duration in "I did it in two days"
+    r"in (\d+|an?|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve) (day|week|month|year)s?|"
+    r"(end|beginning|start|middle) of (the|this|next|last)|"
+    r"(next|last|this|coming|past|previous|following) (summer|winter|spring|fall|autumn|"
+    r"semester|quarter|term|holidays?|season))\b",
+    re.IGNORECASE,
+)
+# Leftovers that mean a relative reference was not fully resolved by the rules.
+UNRESOLVED_DATE_PATTERN = re.compile(
+    rf"\b({_WEEKDAY_RE}|ago|from now|(next|last|this) (week|month|year|{_MONTH_RE}|{_HOLIDAY_RE}))\b",
+    re.IGNORECASE,
+)
+
+
+def _shift_months(day, months):
+    month_index = day.month - 1 + months
+    year = day.year + month_index // 12
+    month = month_index % 12 + 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def _day_label(day):
+    return f"on {day.strftime('%A, %B %d, %Y')}"
+
+
+def _week_label(day):
+    monday = day - timedelta(days=day.weekday())
+    return f"the week of {monday.strftime('%A, %B %d, %Y')}"
+
+
+def _month_label(day):
+    return f"in {day.strftime('%B %Y')}"
+
+
+def _year_label(day):
+    return f"in {day.year}"
+
+
+def _parse_number(word):
+    word = word.lower()
+    return int(word) if word.isdigit() else NUMBER_WORDS[word]
+
+
+def _resolve_offset(amount, unit, today):
+    unit = unit.lower()
+    if unit == "day":
+        return _day_label(today + timedelta(days=amount))
+    if unit == "week":
+        return _day_label(today + timedelta(weeks=amount))
+    if unit == "month":
+        return _month_label(_shift_months(today, amount))
+    return _year_label(today.replace(year=today.year + amount, day=1))
+
+
+def _resolve_weekday(qualifier, name, today):
+    target = WEEKDAYS.index(name.lower())
+    if qualifier == "this":
+        if target < today.weekday():
+            # "this Friday" on a Sunday: the coming Friday or the one just past, only context can tell
+            return None
+        return _day_label(today + timedelta(days=target - today.weekday()))
+    if qualifier == "next":
+        return _day_label(today + timedelta(days=(target - today.weekday()) % 7 or 7))
+    return _day_label(today - timedelta(days=(today.weekday() - target) % 7 or 7))
+
+
+def _resolve_period(qualifier, unit, today):
+    step = {"this": 0, "next": 1, "last": -1}[qualifier]
+    unit = unit.lower()
+    if unit == "week":
+        return _week_label(today + timedelta(weeks=step))
+    if unit == "month":
+        return _month_label(_shift_months(today.replace(day=1), step))
+    return _year_label(today.replace(year=today.year + step, day=1))
+
+
+def _resolve_month(qualifier, name, today):
+    if name.lower() in _MONTH_WORDS_AMBIGUOUS and not name[0].isupper():
+        # "this may help", "this march was brutal": only a capitalised name is taken as the month
+        return None
+    month = MONTHS.index(name.lower()) + 1
+    year = today.year
+    if qualifier == "next" and month <= today.month:
+        year += 1
+    elif qualifier == "last" and month >= today.month:
+        year -= 1
+    return _month_label(today.replace(year=year, month=month, day=1))
+
+
+def _resolve_holiday(qualifier, name, today):
+    spoken = re.sub(r"\s+", " ", name.lower()).replace("’", "").replace("'", "")
+    key = next(h for h in HOLIDAYS if h.replace("'", "") == spoken)
+    month, day = HOLIDAYS[key]
+    holiday = today.replace(month=month, day=day)
+    if qualifier == "next" and holiday <= today:
+        holiday = holiday.replace(year=today.year + 1)
+    elif qualifier == "last" and holiday >= today:
+        holiday = holiday.replace(year=today.year - 1)
+    return _day_label(holiday)
+
+
+# Ordered (pattern, resolver) rules; earlier rules win when one match contains another.
+# A resolver returns None when the match isn't safely a date, which sends the text to the LLM.
+RELATIVE_DATE_RULES = [
+    (re.compile(r"\b(the )?day after tomorrow\b", re.IGNORECASE),
+     lambda m, today: _day_label(today + timedelta(days=2))),
+    (re.compile(r"\b(the )?day before yesterday\b", re.IGNORECASE),
+     lambda m, today: _day_label(today - timedelta(days=2))),
+    (re.compile(r"\b(yesterday|last night)\b", re.IGNORECASE),
+     lambda m, today: _day_label(today - timedelta(days=1))),
+    (re.compile(r"\b(today|tonight|this (morning|afternoon|evening))\b", re.IGNORECASE),
+     lambda m, today: _day_label(today)),
+    (re.compile(r"\btomorrow\b", re.IGNORECASE),
+     lambda m, today: _day_label(today + timedelta(days=1))),
+    (re.compile(rf"\b({_NUMBER_RE}) (day|week|month|year)s? from now\b", re.IGNORECASE),
+     lambda m, today: _resolve_offset(_parse_number(m.group(1)), m.group(2), today)),
+    (re.compile(rf"\b({_NUMBER_RE}) (day|week|month|year)s? ago\b", re.IGNORECASE),
+     lambda m, today: _resolve_offset(-_parse_number(m.group(1)), m.group(2), today)),
+    (re.compile(rf"\b(next|last|this) ({_WEEKDAY_RE})\b", re.IGNORECASE),
+     lambda m, today: _resolve_weekday(m.group(1).lower(), m.group(2), today)),
+    (re.compile(r"\b(next|last|this) (week|month|year)\b", re.IGNORECASE),
+     lambda m, today: _resolve_period(m.group(1).lower(), m.group(2), today)),
+    (re.compile(rf"\b(next|last|this) ({_MONTH_RE})\b", re.IGNORECASE),
+     lambda m, today: _resolve_month(m.group(1).lower(), m.group(2), today)),
+    (re.compile(rf"\b(next|last|this) ({_HOLIDAY_RE})\b", re.IGNORECASE),
+     lambda m, today: _resolve_holiday(m.group(1).lower(), m.group(2), today)),
+]
+# Prepositions that make the leading word of a label redundant in a rewritten query.
+_PREPOSITION_BEFORE = re.compile(r"\b(on|in|during|for|from|since|by|until)\s+$", re.IGNORECASE)
+
+
+# Dates written out by the resolver ("on Monday, January 06, 2025", "the week of ...") or ISO dates
+_EVENT_DATE_PATTERN = re.compile(
+    rf"(week of )?(?:(?:{_WEEKDAY_RE}),? )?({_MONTH_RE}) (\d{{1,2}}),? (\d{{4}})|\b(\d{{4}})-(\d{{2}})-(\d{{2}})\b",
+    re.IGNORECASE,
+)
+_CONVERSATION_SUFFIX_PATTERN = re.compile(r"\s*\(conversation happened on [^)]*\)\s*$", re.IGNORECASE)
+MAX_EVENT_DATES = 31
+
+
+def extract_event_dates(text: str) -> list:
+    """Sorted ISO dates named in standardized text; a "week of" date expands to the whole week."""
+    found = set()
+    for match in _EVENT_DATE_PATTERN.finditer(_CONVERSATION_SUFFIX_PATTERN.sub("", text)):
+        try:
+            if match.group(2):
+                day = datetime(int(match.group(4)), MONTHS.index(match.group(2).lower()) + 1, int(match.group(3))).date()
+            else:
+                day = datetime(int(match.group(5)), int(match.group(6)), int(match.group(7))).date()
+        except ValueError:
+            continue
+        span = 7 if match.group(1) else 1
+        found.update((day + timedelta(days=offset)).isoformat() for offset in range(span))
+    return sorted(found)[:MAX_EVENT_DATES]
+
+
+STOPWORDS = {
+    "a", "about", "an", "and", "any", "are", "at", "can", "did", "do", "does", "for", "from", "had",
+    "have", "how", "i", "in", "is", "it", "me", "my", "of", "on", "or", "remember", "tell", "that",
+    "the", "to", "was", "we", "were", "what", "when", "where", "which", "who", "why", "with", "you",
+}
+
+
+def extract_keywords(query: str) -> str:
+    """Query reduced to its content words, for a keyword-style search variant."""
+    return " ".join(word for word in re.findall(r"[\w'-]+", query) if word.lower() not in STOPWORDS)
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """Fuse ranked result lists; a result scores sum(1 / (k + rank)) over the lists it appears in."""
+    scores, records = {}, {}
+    for ranking in rankings:
+        for rank, record in enumerate(ranking, start=1):
+            key = record.get("ID") or record["TEXT_CONTENT"]
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            records.setdefault(key, record)
+    return [records[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+def split_into_chunks(text: str, max_chars: int = 2000) -> list:
+    """
+    Split a long standardized memory on paragraph, then sentence boundaries into chunks of
+    at most max_chars. The "(conversation happened on ...)" line is kept on every chunk.
+    """
+    suffix_match = _CONVERSATION_SUFFIX_PATTERN.search(text)
+    suffix = suffix_match.group(0) if suffix_match else ""
+    body = text[:suffix_match.start()] if suffix_match else text
+    if len(body) <= max_chars:
+        return [text]
+
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", body):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            while len(sentence) > max_chars:
+                pieces.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            pieces.append(sentence)
+
+    chunks, current = [], ""
+    for piece in pieces:
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if current and len(candidate) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return [chunk.strip() + suffix for chunk in chunks if chunk.strip()]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token for English text)."""
+    return (len(text) + 3) // 4
+
+
 class DateStandardizer:
     def __init__(self, session):
         self.session = session
-    
-    def standardize_dates(self, text, is_query=False):
+        self.stats = {"unchanged": 0, "rule_based": 0, "llm_fallback": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, path):
+        with self._stats_lock:
+            self.stats[path] += 1
+
+    def get_stats(self):
+        """Return how often each standardization path has been taken."""
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def resolve_locally(self, text, current_date, is_query=False):
+        """
+        Rewrite relative dates without calling the LLM.
+        Returns None when the text contains phrasing the rules can't resolve safely.
+        """
+        if AMBIGUOUS_DATE_PATTERN.search(text):
+            return None
+
+        today = current_date['datetime'].date()
+        matches = []
+        claimed = [False] * len(text)
+        for pattern, resolve in RELATIVE_DATE_RULES:
+            for match in pattern.finditer(text):
+                taken = claimed[match.start():match.end()]
+                if all(taken):
+                    continue
+                if any(taken):
+                    # partly overlaps an earlier phrase: "a year ago today"-style combinations
+                    return None
+                label = resolve(match, today)
+                if label is None:
+                    return None
+                claimed[match.start():match.end()] = [True] * (match.end() - match.start())
+                matches.append((match, label))
+
+        matches.sort(key=lambda item: item[0].start())
+        for (previous, _), (following, _) in zip(matches, matches[1:]):
+            if not text[previous.end():following.start()].strip(" ,"):
+                # adjacent phrases qualify each other and can't be resolved one by one
+                return None
+
+        leftover = "".join(" " if taken else char for char, taken in zip(text, claimed))
+        if UNRESOLVED_DATE_PATTERN.search(leftover):
+            return None
+
+        pieces = []
+        position = 0
+        for match, label in matches:
+            pieces.append(text[position:match.start()])
+            if is_query:
+                if label.startswith(("on ", "in ")) and _PREPOSITION_BEFORE.search(text[:match.start()]):
+                    label = label.split(" ", 1)[1]
+                pieces.append(label)
+            else:
+                pieces.append(f"{match.group(0)}({label[0].upper()}{label[1:]})")
+            position = match.end()
+        pieces.append(text[position:])
+        resolved = "".join(pieces)
+
+        self._count("rule_based" if matches else "unchanged")
+        if is_query:
+            return resolved
+        return f"{resolved}\n(conversation happened on {current_date['full_date']} at {current_date['time']})"
+
+    def standardize_dates(self, text, is_query=False, session=None):
+        """Text with relative dates made absolute; an LLM fallback runs on session, or self.session."""
+        with tracer.span("standardize_dates"):
+            return self._standardize_dates(text, is_query, session)
+
+    def _standardize_dates(self, text, is_query=False, session=None):
         try:
             current_date = self.get_current_date_info()
-            
+            resolved = self.resolve_locally(text, current_date, is_query)
+            if resolved is not None:
+                return resolved
+
+            self._count("llm_fallback")
             if is_query:
                 prompt = f"""Current date is {current_date['full_date']}.
                 Convert any relative date references (today, tomorrow, next week, etc.) in this query to actual dates.if there is nothing relative, ignore the date provided, and just provide the query as it is.
@@ -66,7 +576,7 @@ class DateStandardizer:
                 Only output the converted text with no explanations or additional text."""
             
             # Pass session explicitly to Complete
-            response = Complete("mistral-large2", prompt=prompt, session=self.session)
+            response = Complete("mistral-large2", prompt=prompt, session=session or self.session)
             standardized_text = response if response else text
             return standardized_text.strip('"').strip()
         
@@ -77,91 +587,1085 @@ class DateStandardizer:
     def get_current_date_info(self):
         current = datetime.now()
         return {
+            'datetime': current,
             'date': current.strftime('%Y-%m-%d'),
             'day': current.strftime('%A'),
             'full_date': current.strftime('%A, %B %d, %Y'),
             'time': current.strftime('%I:%M %p')
         }
 
-class CortexSearchRetriever:
+class Retriever(ABC):
+    """
+    Memory search backend. retrieve_records returns result rows (at least ID and TEXT_CONTENT),
+    best match first. When event_dates are given the search is restricted to memories about
+    those dates, falling back to an unrestricted search if nothing matches.
+    """
+    def __init__(self):
+        self.last_timings = {}
+
+    def retrieve(self, query: str, event_dates: list = None) -> List[str]:
+        return [record["TEXT_CONTENT"] for record in self.retrieve_records(query, event_dates)]
+
+    @abstractmethod
+    def retrieve_records(self, query: str, event_dates: list = None) -> List[dict]:
+        """Result rows for query, best match first."""
+
+    def refresh(self, snowpark_session=None):
+        """Called when the app switches to another Snowpark session."""
+
+
+class CortexSearchRetriever(Retriever):
     def __init__(self, snowpark_session, limit_to_retrieve: int = 4):
+        super().__init__()
         self._snowpark_session = snowpark_session
         self._limit_to_retrieve = limit_to_retrieve
         self._date_standardizer = DateStandardizer(snowpark_session)
+        self._database = os.getenv("SNOWFLAKE_DATABASE")
+        self._schema = os.getenv("SNOWFLAKE_SCHEMA")
+        self._service_name = os.getenv("SNOWFLAKE_CORTEX_SEARCH")
+        self._search_service = None
+        self._service_session_id = None
+        self.columns = ["ID", "TEXT_CONTENT"]
 
-    def retrieve(self, query: str) -> List[str]:
-        root = Root(self._snowpark_session)
-        cortex_search_service = (
-            root.databases[os.getenv("SNOWFLAKE_DATABASE")]
-            .schemas[os.getenv("SNOWFLAKE_SCHEMA")]
-            .cortex_search_services[os.getenv("SNOWFLAKE_CORTEX_SEARCH")]
-        )
-        resp = cortex_search_service.search(
+    def _get_search_service(self):
+        """Resolve the Cortex Search service once and reuse it until the session changes."""
+        session_id = getattr(self._snowpark_session, "session_id", None)
+        if self._search_service is None or session_id != self._service_session_id:
+            root = Root(self._snowpark_session)
+            self._search_service = (
+                root.databases[self._database]
+                .schemas[self._schema]
+                .cortex_search_services[self._service_name]
+            )
+            self._service_session_id = session_id
+        return self._search_service
+
+    def refresh(self, snowpark_session=None):
+        """Drop the cached service handle, optionally switching to a new session."""
+        if snowpark_session is not None:
+            self._snowpark_session = snowpark_session
+        self._search_service = None
+
+    @staticmethod
+    def date_filter(event_dates: list):
+        """Cortex Search filter matching memories whose EVENT_DATES contain any of the dates."""
+        clauses = [{"@contains": {"EVENT_DATES": day}} for day in event_dates]
+        return clauses[0] if len(clauses) == 1 else {"@or": clauses}
+
+    def _search(self, query: str, timings: dict, event_dates: list = None):
+        started = time.perf_counter()
+        service = self._get_search_service()
+        resolved = time.perf_counter()
+        options = {"filter": self.date_filter(event_dates)} if event_dates else {}
+        resp = service.search(
             query=query,
-            columns=["TEXT_CONTENT"],
+            columns=self.columns,
             limit=self._limit_to_retrieve,
+            **options,
         )
+        timings["resolve_service_ms"] = timings.get("resolve_service_ms", 0.0) + (resolved - started) * 1000
+        timings["search_ms"] = (time.perf_counter() - resolved) * 1000
+        return resp
+
+    def retrieve_records(self, query: str, event_dates: list = None) -> List[dict]:
+        with tracer.span("search"):
+            return self._retrieve(query, event_dates)
+
+    def _retrieve(self, query: str, event_dates: list = None) -> List[dict]:
+        timings = {"resolve_service_ms": 0.0}
+        cached = self._search_service is not None
+        try:
+            resp = self._search(query, timings, event_dates)
+        except Exception as e:
+            if not cached:
+                raise
+            # The cached handle may belong to an expired session; rebuild it once
+            print(f"Search failed on cached service handle, rebuilding: {e}")
+            self.refresh()
+            resp = self._search(query, timings, event_dates)
+        if event_dates:
+            timings["date_filter"] = "applied" if resp.results else "fallback"
+            if not resp.results:
+                resp = self._search(query, timings)
+        self.last_timings = timings
 
         if resp.results:
-            return [curr["TEXT_CONTENT"] for curr in resp.results]
+            return list(resp.results)
         else:
             return []
-        
+
+
+RETRIEVER_BACKENDS = ("cortex", "local")
+
+
+def create_retriever(snowpark_session, limit_to_retrieve: int = 4, backend: str = None,
+                     session_pool: SessionPool = None) -> Retriever:
+    """
+    Search backend picked by backend or MEMEX_RETRIEVER: "cortex" (default) or "local".
+    The local index syncs in the background on a session leased from session_pool when given.
+    """
+    backend = backend or os.getenv("MEMEX_RETRIEVER", "cortex")
+    if backend == "cortex":
+        return CortexSearchRetriever(snowpark_session=snowpark_session, limit_to_retrieve=limit_to_retrieve)
+    if backend == "local":
+        # imported lazily so numpy is only needed with the local backend
+        from local_index import LocalIndexRetriever
+        return LocalIndexRetriever(
+            snowpark_session,
+            limit_to_retrieve=limit_to_retrieve,
+            index_dir=os.getenv("MEMEX_LOCAL_INDEX_DIR", "memex_index"),
+            sync_interval_seconds=float(os.getenv("MEMEX_LOCAL_INDEX_SYNC_INTERVAL", "60")),
+            session_pool=session_pool,
+        )
+    raise ValueError(f"Unknown retriever backend: {backend}")
+
+
+class ContextRelevanceFilter:
+    """
+    Drops retrieved contexts whose relevance to the query scores below the threshold.
+    mode="parallel" grades each context with the feedback function on a bounded thread pool;
+    mode="batched" grades all contexts with a single LLM prompt.
+    """
+    def __init__(self, session, feedback, threshold: float = 0.4, mode: str = "parallel", max_workers: int = 4):
+        if mode not in ("parallel", "batched"):
+            raise ValueError(f"Unknown filter mode: {mode}")
+        self.session = session
+        self.feedback = feedback
+        self.threshold = threshold
+        self.mode = mode
+        self.max_workers = max_workers
+
+    def filter(self, query: str, contexts: list) -> list:
+        if not contexts:
+            return []
+        scores = None
+        if self.mode == "batched":
+            scores = self.score_batched(query, contexts)
+        if scores is None:
+            scores = self.score_parallel(query, contexts)
+        return [context for context, score in zip(contexts, scores) if score >= self.threshold]
+
+    def _score_one(self, query: str, context: str) -> float:
+        try:
+            result = self.feedback(query, context)
+            # feedback functions with reasons return (score, metadata)
+            return float(result[0] if isinstance(result, tuple) else result)
+        except Exception as e:
+            print(f"Error scoring context relevance: {e}")
+            # keep the context rather than silently losing a memory
+            return 1.0
+
+    def score_parallel(self, query: str, contexts: list) -> list:
+        workers = max(1, min(self.max_workers, len(contexts)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda context: self._score_one(query, context), contexts))
+
+    def score_batched(self, query: str, contexts: list):
+        """Score every context in one completion. Returns None if the reply can't be parsed."""
+        numbered = "\n\n".join(f"[{i}] {context}" for i, context in enumerate(contexts))
+        prompt = f"""Rate how relevant each numbered memory is to the question on a scale from 0 to 10,
+        where 0 means unrelated and 10 means it directly answers the question.
+        Question: "{query}"
+
+        Memories:
+        {numbered}
+
+        Only output a JSON array with exactly {len(contexts)} integers, one per memory in order, with no explanations."""
+        try:
+            response = Complete("mistral-large2", prompt, session=self.session)
+            match = re.search(r"\[[^\[\]]*\]", response or "")
+            scores = json.loads(match.group(0)) if match else None
+            if not scores or len(scores) != len(contexts):
+                print(f"Unexpected batched relevance reply, falling back to per-context grading: {response}")
+                return None
+            return [min(max(float(score), 0.0), 10.0) / 10 for score in scores]
+        except Exception as e:
+            print(f"Error in batched relevance scoring: {e}")
+            return None
+
+
+class ContextAssembler:
+    """
+    Formats retrieved memories for the prompt as a numbered list within token_budget.
+    A memory longer than memory_token_budget is cut down to the sentences sharing the most words
+    with the question, plus their neighbours; lower-ranked memories get whatever budget is left.
+    """
+    def __init__(self, token_budget: int = 1200, memory_token_budget: int = 300, min_memory_tokens: int = 25):
+        self.token_budget = token_budget
+        self.memory_token_budget = memory_token_budget
+        self.min_memory_tokens = min_memory_tokens
+        self.stats = {"requests": 0, "raw_tokens": 0, "context_tokens": 0, "excerpted": 0, "dropped": 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _words(text: str) -> set:
+        return {word.lower() for word in re.findall(r"[\w'-]+", text)}
+
+    def excerpt(self, text: str, query: str, max_tokens: int) -> str:
+        """text shortened to about max_tokens around the sentences relevant to query."""
+        suffix_match = _CONVERSATION_SUFFIX_PATTERN.search(text)
+        suffix = f" {suffix_match.group(0).strip()}" if suffix_match else ""
+        body = " ".join((text[:suffix_match.start()] if suffix_match else text).split())
+        max_tokens -= estimate_tokens(suffix)
+        if estimate_tokens(body) <= max_tokens:
+            return body + suffix
+
+        sentences = re.split(r"(?<=[.!?])\s+", body)
+        keywords = self._words(extract_keywords(query))
+        scores = [len(keywords & self._words(sentence)) for sentence in sentences]
+        order = sorted(range(len(sentences)), key=lambda i: (-scores[i], i))
+        keep, used = set(), 0
+        for i in order:
+            for j in (i, i - 1, i + 1):
+                if 0 <= j < len(sentences) and j not in keep:
+                    cost = estimate_tokens(sentences[j]) + 1
+                    if used + cost <= max_tokens:
+                        keep.add(j)
+                        used += cost
+        if not keep:
+            return sentences[order[0]][:max(max_tokens, 0) * 4].rstrip() + " …" + suffix
+
+        parts, previous = [], -1
+        for i in sorted(keep):
+            if i != previous + 1:
+                parts.append("…")
+            parts.append(sentences[i])
+            previous = i
+        if previous != len(sentences) - 1:
+            parts.append("…")
+        return " ".join(parts) + suffix
+
+    def assemble(self, query: str, contexts: list) -> tuple:
+        """Returns (formatted memories, stats for this request)."""
+        remaining = self.token_budget
+        lines, excerpted, dropped = [], 0, 0
+        for text in contexts:
+            share = min(self.memory_token_budget, remaining)
+            if share < self.min_memory_tokens:
+                dropped += 1
+                continue
+            memory = self.excerpt(text, query, share)
+            if "…" in memory:
+                excerpted += 1
+            line = f"{len(lines) + 1}. {memory}"
+            remaining -= estimate_tokens(line) + 1
+            lines.append(line)
+        formatted = "\n".join(lines)
+
+        request = {
+            # what the raw list repr of the memories used to cost
+            "raw_tokens": estimate_tokens(str(contexts)),
+            "context_tokens": estimate_tokens(formatted),
+            "excerpted": excerpted,
+            "dropped": dropped,
+        }
+        with self._lock:
+            self.stats["requests"] += 1
+            for key, value in request.items():
+                self.stats[key] += value
+        request["tokens_saved"] = request["raw_tokens"] - request["context_tokens"]
+        return formatted, request
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["tokens_saved"] = stats["raw_tokens"] - stats["context_tokens"]
+        return stats
+
+
+class AnswerCache:
+    """
+    LRU cache of generated answers with a TTL.
+    Entries are keyed on the standardized query plus a fingerprint of the retrieved memories,
+    so an answer is only reused when search returns the same memories it was generated from.
+    With near_duplicate_threshold set, a query whose word overlap (Jaccard) with a cached query
+    meets the threshold, and that retrieved the same memories, also counts as a hit.
+    """
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 3600, near_duplicate_threshold: float = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(re.findall(r"\w+", query.lower()))
+
+    @staticmethod
+    def fingerprint(contexts: list) -> str:
+        digest = hashlib.sha256()
+        for context in contexts:
+            digest.update(hashlib.sha256(context.encode("utf-8")).digest())
+        return digest.hexdigest()
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.monotonic() - stored_at > self.ttl_seconds
+
+    def _near_duplicate(self, normalized: str, fingerprint: str):
+        words = set(normalized.split())
+        best_key, best_score = None, self.near_duplicate_threshold
+        for key, (_, stored_at) in self._entries.items():
+            if key[1] != fingerprint or self._expired(stored_at):
+                continue
+            cached_words = set(key[0].split())
+            union = words | cached_words
+            score = len(words & cached_words) / len(union) if union else 1.0
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def get(self, query: str, contexts: list):
+        normalized = self.normalize(query)
+        fingerprint = self.fingerprint(contexts)
+        key = (normalized, fingerprint)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            if self.near_duplicate_threshold is not None:
+                near_key = self._near_duplicate(normalized, fingerprint)
+                if near_key is not None:
+                    self._entries.move_to_end(near_key)
+                    self.stats["near_hits"] += 1
+                    return self._entries[near_key][0]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, query: str, contexts: list, answer: str):
+        key = (self.normalize(query), self.fingerprint(contexts))
+        with self._lock:
+            self._entries[key] = (answer, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats["invalidations"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["near_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["near_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+class RecentWritesBuffer:
+    """
+    Memories written by this process that the Cortex Search index may not have picked up yet
+    (the service refreshes with TARGET_LAG = '1 minute'). Searched locally with BM25 and
+    dropped once they are older than ttl_seconds or show up in search results.
+    """
+    def __init__(self, ttl_seconds: float = 120, k1: float = 1.5, b: float = 0.75):
+        self.ttl_seconds = ttl_seconds
+        self.k1 = k1
+        self.b = b
+        self._entries = []  # (text, tokens, written_at, event dates)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        return re.findall(r"\w+", text.lower())
+
+    def add(self, texts: list, event_dates: list = None):
+        """Buffer texts; event_dates holds the EVENT_DATES list of each text."""
+        now = time.monotonic()
+        event_dates = event_dates or [[] for _ in texts]
+        with self._lock:
+            self._entries.extend(
+                (text, self.tokenize(text), now, set(dates)) for text, dates in zip(texts, event_dates)
+            )
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        self._entries = [entry for entry in self._entries if entry[2] >= cutoff]
+
+    def discard(self, texts: list):
+        """Forget memories that the search index already returns."""
+        indexed = set(texts)
+        with self._lock:
+            self._entries = [entry for entry in self._entries if entry[0] not in indexed]
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            return len(self._entries)
+
+    def search(self, query: str, limit: int = 4, event_dates: list = None) -> list:
+        """Buffered texts matching the query's content words, restricted to event_dates if given."""
+        with self._lock:
+            self._expire()
+            entries = list(self._entries)
+        if event_dates:
+            wanted = set(event_dates)
+            entries = [entry for entry in entries if entry[3] & wanted]
+        query_terms = set(self.tokenize(extract_keywords(query)))
+        if not entries or not query_terms:
+            return []
+
+        average_length = sum(len(tokens) for _, tokens, _, _ in entries) / len(entries)
+        document_frequency = {
+            term: sum(1 for _, tokens, _, _ in entries if term in tokens) for term in query_terms
+        }
+        scored = []
+        for text, tokens, _, _ in entries:
+            score = 0.0
+            for term in query_terms:
+                frequency = tokens.count(term)
+                if not frequency:
+                    continue
+                df = document_frequency[term]
+                idf = math.log(1 + (len(entries) - df + 0.5) / (df + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * len(tokens) / (average_length or 1))
+                score += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            if score > 0:
+                scored.append((score, text))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [text for _, text in scored[:limit]]
+
+
+EVALUATION_MODES = ("inline", "sampled-async", "off")
+
+
+class SampledEvaluator:
+    """
+    Scores a sample of answered queries with the RAG triad (context relevance, groundedness,
+    answer relevance) on a background thread, after the answer has been returned.
+    Scores are kept in memory and appended to log_path as JSONL when one is given.
+    """
+    def __init__(self, provider, sample_rate: float = 0.1, log_path: str = None,
+                 max_pending: int = 50, max_results: int = 500):
+        self.provider = provider
+        self.sample_rate = sample_rate
+        self.log_path = log_path
+        self.results = []
+        self.max_results = max_results
+        self.stats = {"sampled": 0, "skipped": 0, "dropped": 0, "evaluated": 0, "failed": 0}
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._worker = threading.Thread(target=self._run, name="memex-evaluation", daemon=True)
+        self._worker.start()
+
+    def maybe_submit(self, query: str, contexts: list, response: str):
+        """Queue the exchange for scoring with probability sample_rate. Never blocks."""
+        if self._random.random() >= self.sample_rate:
+            self.stats["skipped"] += 1
+            return False
+        try:
+            self._queue.put_nowait((query, list(contexts), response, datetime.now().isoformat(timespec="seconds")))
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["sampled"] += 1
+        return True
+
+    @staticmethod
+    def _score(result):
+        return float(result[0] if isinstance(result, tuple) else result)
+
+    def evaluate(self, query: str, contexts: list, response: str) -> dict:
+        scores = {
+            "answer_relevance": self._score(self.provider.relevance(query, response)),
+            "context_relevance": None,
+            "groundedness": None,
+        }
+        if contexts:
+            relevance = [self._score(self.provider.context_relevance(query, context)) for context in contexts]
+            scores["context_relevance"] = sum(relevance) / len(relevance)
+            scores["groundedness"] = self._score(
+                self.provider.groundedness_measure_with_cot_reasons("\n".join(contexts), response)
+            )
+        return scores
+
+    def _run(self):
+        while True:
+            query, contexts, response, asked_at = self._queue.get()
+            try:
+                with tracer.span("evaluation"):
+                    scores = self.evaluate(query, contexts, response)
+                record = {"asked_at": asked_at, "query": query, **scores}
+                with self._lock:
+                    self.results.append(record)
+                    del self.results[:-self.max_results]
+                    self.stats["evaluated"] += 1
+                if self.log_path:
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record) + "\n")
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Error evaluating response: {e}")
+            finally:
+                self._queue.task_done()
+
+    def summary(self) -> dict:
+        """Average scores over the evaluated sample."""
+        with self._lock:
+            results = list(self.results)
+        summary = dict(self.stats)
+        for metric in ("context_relevance", "groundedness", "answer_relevance"):
+            values = [r[metric] for r in results if r[metric] is not None]
+            summary[metric] = sum(values) / len(values) if values else None
+        return summary
+
+    def join(self):
+        self._queue.join()
+
+
+def create_evaluator(session, sample_rate: float = None) -> SampledEvaluator:
+    """SampledEvaluator scoring with a Cortex provider on session, configured from the environment."""
+    if sample_rate is None:
+        sample_rate = float(os.getenv("MEMEX_EVALUATION_SAMPLE_RATE", "0.1"))
+    return SampledEvaluator(
+        create_provider(session),
+        sample_rate=sample_rate,
+        log_path=os.getenv("MEMEX_EVALUATION_LOG"),
+    )
+
+
+def create_search_executor(max_workers: int = 4) -> ThreadPoolExecutor:
+    """Thread pool for concurrent searches (speculative and multi-query retrieval)."""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="memex-search")
+
+
+# Questions leaning on the previous turn: those opening with a connective ("and the day after?",
+# "what about her?") and very short ones that only point back ("where was that?")
+FOLLOW_UP_PATTERN = re.compile(
+    r"^\s*(and|but|also|then|so|what about|how about|what else|before that|after that|"
+    r"the (day|week) (after|before)|the (next|previous|following) (day|week))\b",
+    re.IGNORECASE,
+)
+ELLIPTICAL_PATTERN = re.compile(r"\b(it|that|this|those|they|them|he|she|him|her|there|then)\b", re.IGNORECASE)
+ELLIPTICAL_MAX_WORDS = 4
+# Follow-ups whose date is relative to the previous question's ("and the day after?")
+RELATIVE_FOLLOW_UP_PATTERN = re.compile(
+    r"\b(?:the )?(day|week) (after|before)\b|\bthe (next|previous|following) (day|week)\b",
+    re.IGNORECASE,
+)
+# Date phrases of an earlier question, which must not narrow the search for the current one
+_DATE_PHRASE_PATTERNS = [pattern for pattern, _ in RELATIVE_DATE_RULES] + [
+    AMBIGUOUS_DATE_PATTERN,
+    _EVENT_DATE_PATTERN,
+    UNRESOLVED_DATE_PATTERN,
+    re.compile(rf"\b({_WEEKDAY_RE}|{_MONTH_RE}|{_HOLIDAY_RE})\b|\b\d{{1,2}}(st|nd|rd|th)\b|\b\d{{4}}\b", re.IGNORECASE),
+]
+
+
+class ConversationMemory:
+    """
+    Bounded view of the chat history for prompting.
+    Recent turns are kept verbatim up to token_budget. When they outgrow it, the oldest turns are
+    folded into a running summary with one LLM call, leaving about half the budget verbatim, so the
+    summary is only extended every few turns and never rebuilt from the whole history.
+    """
+    def __init__(self, session, token_budget: int = 1000, summary_token_budget: int = 250):
+        self.session = session
+        self.token_budget = token_budget
+        self.summary_token_budget = summary_token_budget
+        self.summary = ""
+        self.summarized_turns = 0
+        self.stats = {"compactions": 0}
+        self._question_dates = OrderedDict()  # recent user question -> event dates it was searched with
+
+    @staticmethod
+    def _turn_text(message) -> str:
+        speaker = "User" if message["role"] == "user" else "memex"
+        return f"{speaker}: {message['content']}"
+
+    def _tokens(self, turns) -> int:
+        return sum(estimate_tokens(self._turn_text(turn)) for turn in turns)
+
+    def _summarize(self, turns) -> str:
+        transcript = "\n".join(self._turn_text(turn) for turn in turns)
+        prompt = f"""Update the running summary of a conversation between a user and memex, their memory companion.
+        Keep names, dates, places and what the user asked about. Stay under {self.summary_token_budget * 3 // 4} words.
+
+        Current summary: "{self.summary}"
+
+        New turns:
+        {transcript}
+
+        Only output the updated summary with no explanations or additional text."""
+        try:
+            response = Complete("mistral-large2", prompt, session=self.session)
+            return (response or "").strip().strip('"')
+        except Exception as e:
+            print(f"Error summarizing conversation: {e}")
+            # keep the gist cheaply rather than losing the turns entirely
+            return (self.summary + " " + transcript)[-self.summary_token_budget * 4:].strip()
+
+    def window(self, history: list):
+        """Return (running summary, recent turns) for history, compacting old turns if needed."""
+        if len(history) < self.summarized_turns:
+            # a new conversation started (e.g. the chat was cleared)
+            self.summary, self.summarized_turns = "", 0
+        recent = history[self.summarized_turns:]
+        if self._tokens(recent) > self.token_budget:
+            cut = 0
+            while cut < len(recent) - 1 and self._tokens(recent[cut:]) > self.token_budget // 2:
+                cut += 1
+            with tracer.span("conversation_summary"):
+                self.summary = self._summarize(recent[:cut])
+            self.summarized_turns += cut
+            self.stats["compactions"] += 1
+            recent = recent[cut:]
+        return self.summary, recent
+
+    def render(self, history: list) -> str:
+        summary, recent = self.window(history)
+        lines = [f"Summary of earlier conversation: {summary}"] if summary else []
+        lines += [self._turn_text(turn) for turn in recent]
+        return "\n".join(lines)
+
+    @staticmethod
+    def is_follow_up(query: str) -> bool:
+        if FOLLOW_UP_PATTERN.search(query):
+            return True
+        return len(query.split()) <= ELLIPTICAL_MAX_WORDS and bool(ELLIPTICAL_PATTERN.search(query))
+
+    def remember_dates(self, question: str, event_dates: list):
+        """Record the event dates a question was searched with, for follow-ups relative to them."""
+        self._question_dates[question] = event_dates
+        self._question_dates.move_to_end(question)
+        while len(self._question_dates) > 20:
+            self._question_dates.popitem(last=False)
+
+    @staticmethod
+    def resolve_relative_follow_up(query: str, previous_dates: list) -> str:
+        """query with "the day after", "the previous week" etc. replaced by dates relative to previous_dates."""
+        match = RELATIVE_FOLLOW_UP_PATTERN.search(query)
+        if not match or not previous_dates:
+            return query
+        unit = (match.group(1) or match.group(4)).lower()
+        forward = (match.group(2) or match.group(3)).lower() in ("after", "next", "following")
+        base = datetime.strptime(previous_dates[-1] if forward else previous_dates[0], "%Y-%m-%d").date()
+        step = timedelta(days=1 if unit == "day" else 7)
+        target = base + step if forward else base - step
+        if unit == "week":
+            target -= timedelta(days=target.weekday())
+        # without the weekday name, which the local resolver would take for an unresolved reference
+        label = f"{'on' if unit == 'day' else 'the week of'} {target.strftime('%B %d, %Y')}"
+        return f"{query[:match.start()]}{label}{query[match.end():]}"
+
+    def search_query(self, query: str, history: list) -> str:
+        """
+        Query to search with: a follow-up question is prefixed with the keywords of the previous user
+        question, without its dates, so only the follow-up's own dates restrict the search. Dates
+        relative to the previous question ("and the day after?") are resolved against the dates it
+        was searched with.
+        """
+        previous = [message["content"] for message in history if message["role"] == "user"]
+        if not previous or not self.is_follow_up(query):
+            return query
+        query = self.resolve_relative_follow_up(query, self._question_dates.get(previous[-1], []))
+        topic = previous[-1]
+        for pattern in _DATE_PHRASE_PATTERNS:
+            topic = pattern.sub(" ", topic)
+        topic = extract_keywords(topic)
+        return f"{topic} {query}" if topic else query
+
+
+class StoredSignatures:
+    """
+    Process-wide DuplicateIndex of TEXT_PARAGRAPHS_TABLE, shared by every RAG_from_scratch so that
+    memories from all browser sessions are checked against each other. The table is loaded on
+    first use; later refreshes only add rows with an ID above the last one loaded. Writers hold
+    lock from the duplicate check until the COMMIT.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._index = None
+        self._last_id = -1
+
+    def refresh(self, session) -> DuplicateIndex:
+        with self.lock:
+            if self._index is None:
+                self._index, self._last_id = DuplicateIndex(), -1
+            rows = session.sql("""
+                SELECT ID, ENTRY_ID, CONTENT_HASH, MINHASH, CREATED_AT FROM TEXT_PARAGRAPHS_TABLE
+                WHERE CHUNK_INDEX = 0 AND CONTENT_HASH IS NOT NULL AND ID > ?
+                ORDER BY ID
+            """, params=[self._last_id]).collect()
+            for row in rows:
+                self._index.add(row["ENTRY_ID"], row["CONTENT_HASH"], row["MINHASH"], written_on(row["CREATED_AT"]))
+                self._last_id = max(self._last_id, row["ID"])
+            return self._index
+
+    def reset(self):
+        """Reload the whole table on the next refresh."""
+        with self.lock:
+            self._index = None
+
+
+stored_signatures = StoredSignatures()
+
 
 class RAG_from_scratch:
-    def __init__(self, session):
+    def __init__(self, session, filter_mode: str = "parallel", filter_max_workers: int = 4,
+                 cache_answers: bool = True, cache_ttl_seconds: float = 3600,
+                 cache_near_duplicate_threshold: float = None, recent_writes_ttl_seconds: float = 120,
+                 speculative_search: bool = False, evaluation_mode: str = None,
+                 evaluation_sample_rate: float = None, multi_query: bool = False,
+                 history_token_budget: int = None, context_token_budget: int = None,
+                 retriever_backend: str = None, dedup_policy: str = None,
+                 evaluator: "SampledEvaluator" = None, search_executor: ThreadPoolExecutor = None,
+                 session_pool: SessionPool = None):
         self.session = session
-        self.retriever = CortexSearchRetriever(snowpark_session=session, limit_to_retrieve=4)
+        self.limit_to_retrieve = 4
+        self.max_chunk_chars = 2000
+        self.retriever = create_retriever(session, self.limit_to_retrieve, retriever_backend, session_pool)
         self.date_standardizer = DateStandardizer(session)
+        self.last_timings = {}
+        self.recent_writes = RecentWritesBuffer(ttl_seconds=recent_writes_ttl_seconds)
+        self.dedup_policy = dedup_policy or os.getenv("MEMEX_DEDUP_POLICY", "skip")
+        if self.dedup_policy not in DEDUP_POLICIES:
+            raise ValueError(f"Unknown dedup policy: {self.dedup_policy}")
+        self.stored_signatures = stored_signatures
+        self.speculative_search = speculative_search
+        self.multi_query = multi_query
+        if history_token_budget is None:
+            history_token_budget = int(os.getenv("MEMEX_HISTORY_TOKEN_BUDGET", "1000"))
+        self.conversation = ConversationMemory(session, token_budget=history_token_budget)
+        if context_token_budget is None:
+            context_token_budget = int(os.getenv("MEMEX_CONTEXT_TOKEN_BUDGET", "1200"))
+        self.context_assembler = ContextAssembler(token_budget=context_token_budget)
+        self.speculation_stats = {"used": 0, "wasted": 0}
+        self._stats_lock = threading.Lock()
+        # the app shares one search pool and evaluator between all sessions; otherwise each instance starts its own
+        self._search_executor = search_executor or create_search_executor()
+        self.answer_cache = None
+        if cache_answers:
+            self.answer_cache = AnswerCache(
+                ttl_seconds=cache_ttl_seconds,
+                near_duplicate_threshold=cache_near_duplicate_threshold,
+            )
         
-        # Initialize Cortex provider
-        self.provider = Cortex(
-            session,
-            model_engine="mistral-large2",
-        )
-        
-        # Initialize feedback score
-        self.context_relevance_score = Feedback(
-            self.provider.context_relevance,
-            name="Context Relevance"
-        )
+        # inline: relevance guardrail in the request path; sampled-async: a sample of answers
+        # is scored in the background; off: no LLM-based evaluation at all
+        self.evaluation_mode = evaluation_mode or os.getenv("MEMEX_EVALUATION_MODE", "inline")
+        if self.evaluation_mode not in EVALUATION_MODES:
+            raise ValueError(f"Unknown evaluation mode: {self.evaluation_mode}")
+        self.provider = None
+        self.context_relevance_score = None
+        self.context_filter = None
+        self.evaluator = None
+
+        if self.evaluation_mode != "off":
+            enable_trulens_instrumentation()
+
+        if self.evaluation_mode == "inline":
+            from trulens.core import Feedback
+            # Initialize Cortex provider
+            self.provider = create_provider(session)
+            # Initialize feedback score
+            self.context_relevance_score = Feedback(
+                self.provider.context_relevance,
+                name="Context Relevance"
+            )
+            self.context_filter = ContextRelevanceFilter(
+                session,
+                self.context_relevance_score,
+                threshold=0.4,
+                mode=filter_mode,
+                max_workers=filter_max_workers,
+            )
+        elif self.evaluation_mode == "sampled-async":
+            if evaluator is None:
+                evaluator = create_evaluator(session, evaluation_sample_rate)
+                self.provider = evaluator.provider
+            self.evaluator = evaluator
+
+    def set_session(self, session):
+        """Point every component at a new Snowpark session, e.g. after the pool replaced an expired one."""
+        if session is self.session:
+            return
+        self.session = session
+        self.retriever.refresh(session)
+        self.date_standardizer.session = session
+        self.conversation.session = session
+        if self.provider is not None:
+            previous_provider, self.provider = self.provider, create_provider(session)
+            if self.evaluator is not None and self.evaluator.provider is previous_provider:
+                # only this instance's own evaluator follows it; a shared one keeps its session
+                self.evaluator.provider = self.provider
+        if self.context_filter is not None:
+            from trulens.core import Feedback
+            self.context_relevance_score = Feedback(self.provider.context_relevance, name="Context Relevance")
+            self.context_filter.session = session
+            self.context_filter.feedback = self.context_relevance_score
 
     def inject_information(self, text_content):
-        try:
-            standardized_text = self.date_standardizer.standardize_dates(text_content)
-            
-            query = """
-            INSERT INTO TEXT_PARAGRAPHS_TABLE (TEXT_CONTENT)
-            VALUES (?)
-            """
-            result = self.session.sql(query, params=[standardized_text]).collect()
-            self.session.sql("COMMIT").collect()
-            return True
-        except Exception as e:
-            print(f"Error injecting information: {e}")
-            return False
+        return self.inject_many([text_content])[0]["success"]
+
+    def inject_many(self, texts, chunk_size=500, max_workers=8):
+        """
+        Standardize and store many memories at once.
+        Entries are standardized concurrently, then written with one multi-row
+        INSERT and one COMMIT per chunk. Returns one result dict per input text;
+        duplicate_of is set for memories skipped as duplicates of a stored one.
+        """
+        results = [{"index": i, "success": False, "error": None, "duplicate_of": None} for i in range(len(texts))]
+        if not texts:
+            return results
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            standardized = list(executor.map(self.date_standardizer.standardize_dates, texts))
+
+        for start in range(0, len(standardized), chunk_size):
+            chunk = standardized[start:start + chunk_size]
+            try:
+                outcomes = self.write_memories(chunk)
+                for i, outcome in zip(range(start, start + len(chunk)), outcomes):
+                    results[i]["success"] = True
+                    results[i]["duplicate_of"] = outcome["duplicate_of"]
+            except Exception as e:
+                print(f"Error injecting information: {e}")
+                for i in range(start, start + len(chunk)):
+                    results[i]["error"] = str(e)
+        return results
+
+    def memory_rows(self, standardized_text: str, created_at: datetime, signature: tuple = (None, None)) -> list:
+        """
+        Rows for one memory: long entries are split into chunks sharing an ENTRY_ID.
+        EVENT_DATES holds the dates the memory talks about plus the day it was written.
+        signature is the (CONTENT_HASH, MINHASH) of the whole memory, stored on every chunk.
+        """
+        entry_id = uuid.uuid4().hex
+        event_dates = extract_event_dates(standardized_text)
+        written_on = created_at.date().isoformat()
+        if written_on not in event_dates:
+            event_dates = sorted(event_dates + [written_on])
+        return [
+            (chunk, entry_id, index, created_at.strftime("%Y-%m-%d %H:%M:%S"), json.dumps(event_dates), *signature)
+            for index, chunk in enumerate(split_into_chunks(standardized_text, self.max_chunk_chars))
+        ]
 
-    @instrument
-    def retrieve_context_with_filter(self, query: str) -> list:
+    def duplicate_index(self, session=None) -> DuplicateIndex:
+        """Signatures of the stored memories, including those written since the last call."""
+        return self.stored_signatures.refresh(session or self.session)
+
+    def write_memories(self, standardized_texts: list, session=None) -> list:
         """
-        Wrapper method to apply filtering based on context_relevance_score.
+        INSERT already standardized memories in one statement and COMMIT. Raises on failure.
+        Duplicates of stored memories are handled by dedup_policy: "skip" drops exact and near
+        duplicates, "merge" drops exact duplicates and lets a near duplicate replace the stored
+        version, "keep" stores everything. Only memories stored earlier the same day count as duplicates. Returns {"entry_id", "duplicate_of", "replaced"} per text.
+        Runs on session when given (background writers lease their own), else on self.session.
         """
-        @context_filter(self.context_relevance_score, 0.4, keyword_for_prompt="query")
-        def _retrieve(query: str) -> list:
+        session = session or self.session
+        created_at = datetime.now()
+        day = written_on(created_at)
+        rows, outcomes, replaced = [], [], []
+        with self.stored_signatures.lock:
+            index = self.duplicate_index(session) if self.dedup_policy != "keep" else None
+            for text in standardized_texts:
+                signature = content_signature(text)
+                match = index.find(*signature, day) if index is not None else None
+                if match and (self.dedup_policy == "skip" or match[0] == "exact"):
+                    outcomes.append({"entry_id": None, "duplicate_of": match[1], "replaced": None})
+                    continue
+                entry_rows = self.memory_rows(text, created_at, signature)
+                entry_id = entry_rows[0][1]
+                if match:
+                    replaced.append(match[1])
+                    index.remove(match[1])
+                if index is not None:
+                    # later texts of the same batch are checked against this one too
+                    index.add(entry_id, *signature, day)
+                rows.extend(entry_rows)
+                outcomes.append({"entry_id": entry_id, "duplicate_of": None,
+                                 "replaced": match[1] if match else None})
+            if not rows:
+                return outcomes
+
+            placeholders = ", ".join(["(?, ?, ?, ?, ?, ?, ?)"] * len(rows))
+            query = f"""
+            INSERT INTO TEXT_PARAGRAPHS_TABLE (TEXT_CONTENT, ENTRY_ID, CHUNK_INDEX, CREATED_AT, EVENT_DATES, CONTENT_HASH, MINHASH)
+            SELECT column1, column2, column3, column4::TIMESTAMP_NTZ, PARSE_JSON(column5), column6, column7
+            FROM VALUES {placeholders}
+            """
+            try:
+                with tracer.span("insert"):
+                    session.sql(query, params=[value for row in rows for value in row]).collect()
+                if replaced:
+                    # after the INSERT, so a failure leaves both versions rather than neither;
+                    # DELETED_MEMORIES tells local indexes which rows to drop
+                    placeholders = ", ".join(["?"] * len(replaced))
+                    session.sql(
+                        f"INSERT INTO DELETED_MEMORIES (ID) SELECT ID FROM TEXT_PARAGRAPHS_TABLE WHERE ENTRY_ID IN ({placeholders})",
+                        params=replaced,
+                    ).collect()
+                    session.sql(f"DELETE FROM TEXT_PARAGRAPHS_TABLE WHERE ENTRY_ID IN ({placeholders})",
+                                params=replaced).collect()
+                with tracer.span("commit"):
+                    session.sql("COMMIT").collect()
+            except Exception:
+                # the index may now disagree with the table; reload it on the next write
+                self.stored_signatures.reset()
+                raise
+        self.recent_writes.add([row[0] for row in rows], [json.loads(row[4]) for row in rows])
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate()
+        return outcomes
+
+    def retrieve_candidates(self, query: str):
+        """Standardize the query and search. Returns (standardized query, retrieved contexts)."""
+        if self.multi_query:
+            standard_query, contexts = self._multi_query_retrieve(query)
+        elif self.speculative_search:
+            standard_query, contexts = self._speculative_retrieve(query)
+        else:
+            started = time.perf_counter()
             standard_query = self.date_standardizer.standardize_dates(query, is_query=True)
-            return self.retriever.retrieve(standard_query)
-        
-        return _retrieve(query)
+            self.last_timings["standardize_ms"] = (time.perf_counter() - started) * 1000
+            contexts = self.retriever.retrieve(standard_query, extract_event_dates(standard_query))
+            self.last_timings.update(self.retriever.last_timings)
+        return standard_query, self.merge_recent_writes(standard_query, contexts)
+
+    def _multi_query_retrieve(self, query: str):
+        """
+        Search several forms of the query concurrently and fuse the rankings with reciprocal-rank fusion.
+        The raw query and its keywords are searched (filtered by any dates they already name) while the
+        query is standardized; the standardized query and its keywords, with the date filter, are added
+        if standardization changed anything. When the query names dates, only rankings filtered by
+        exactly those dates are fused.
+        """
+        started = time.perf_counter()
+        submitted = {}
+
+        def submit(variant, event_dates):
+            key = (variant, tuple(event_dates))
+            if variant and key not in submitted:
+                submitted[key] = self._search_executor.submit(self.retriever.retrieve_records, variant, event_dates)
+
+        raw_dates = extract_event_dates(query)
+        submit(query, raw_dates)
+        submit(extract_keywords(query), raw_dates)
+        standard_query = self.date_standardizer.standardize_dates(query, is_query=True)
+        self.last_timings["standardize_ms"] = (time.perf_counter() - started) * 1000
+        event_dates = extract_event_dates(standard_query)
+        submit(standard_query, event_dates)
+        submit(extract_keywords(standard_query), event_dates)
+
+        rankings = []
+        for (variant, dates), future in submitted.items():
+            try:
+                ranking = future.result()
+            except Exception as e:
+                print(f"Search failed for query variant {variant!r}: {e}")
+                continue
+            if not event_dates or list(dates) == event_dates:
+                rankings.append(ranking)
+        if not rankings:
+            raise RuntimeError("All query variant searches failed")
+        self.last_timings["query_variants"] = len(submitted)
+        self.last_timings["search_ms"] = (time.perf_counter() - started) * 1000 - self.last_timings["standardize_ms"]
+        fused = reciprocal_rank_fusion(rankings)[:self.limit_to_retrieve]
+        return standard_query, [record["TEXT_CONTENT"] for record in fused]
+
+    def _speculative_retrieve(self, query: str):
+        """
+        Search with the raw query while the query is being standardized.
+        If standardization leaves the query unchanged the speculative results are used as they are,
+        otherwise the standardized query is searched too and its results take precedence. Raw results
+        are only kept when standardization found no event dates, as they lack that date filter.
+        """
+        started = time.perf_counter()
+        speculative = self._search_executor.submit(self._retrieve_with_timings, query, extract_event_dates(query))
+        standard_query = self.date_standardizer.standardize_dates(query, is_query=True)
+        self.last_timings["standardize_ms"] = (time.perf_counter() - started) * 1000
+        raw_contexts, timings = speculative.result()
+        self.last_timings.update(timings)
+
+        if standard_query.strip() == query.strip():
+            self._count_speculation("used")
+            return standard_query, raw_contexts
+
+        self._count_speculation("wasted")
+        event_dates = extract_event_dates(standard_query)
+        contexts, timings = self._retrieve_with_timings(standard_query, event_dates)
+        self.last_timings.update(timings)
+        if event_dates:
+            return standard_query, contexts
+        merged = contexts + [context for context in raw_contexts if context not in contexts]
+        return standard_query, merged[:self.limit_to_retrieve]
+
+    def _retrieve_with_timings(self, query: str, event_dates: list = None):
+        """(contexts, retriever timings), reading the timings in the thread that ran the search"""
+        contexts = self.retriever.retrieve(query, event_dates)
+        return contexts, dict(self.retriever.last_timings)
+
+    def _count_speculation(self, outcome: str):
+        with self._stats_lock:
+            self.speculation_stats[outcome] += 1
+        self.last_timings["speculation"] = outcome
+
+    def get_speculation_stats(self):
+        with self._stats_lock:
+            stats = dict(self.speculation_stats)
+        total = stats["used"] + stats["wasted"]
+        stats["hit_rate"] = stats["used"] / total if total else 0.0
+        return stats
+
+    def merge_recent_writes(self, query: str, contexts: list) -> list:
+        """
+        Fuse matching memories that are not searchable yet into the search results,
+        applying the same date restriction and keeping at most limit_to_retrieve contexts.
+        """
+        self.recent_writes.discard(contexts)
+        recent = self.recent_writes.search(query, limit=self.limit_to_retrieve, event_dates=extract_event_dates(query))
+        if not recent:
+            return contexts
+        fused = reciprocal_rank_fusion([
+            [{"TEXT_CONTENT": text} for text in contexts],
+            [{"TEXT_CONTENT": text} for text in recent],
+        ])
+        return [record["TEXT_CONTENT"] for record in fused[:self.limit_to_retrieve]]
+
+    def retrieve_context_with_filter(self, query: str, candidates: list = None) -> list:
+        """
+        Retrieve context and drop chunks below the context relevance threshold.
+        Already retrieved candidates can be passed in to skip the search.
+        Outside inline evaluation mode no relevance grading happens here.
+        """
+        if candidates is None:
+            _, candidates = self.retrieve_candidates(query)
+        if self.context_filter is None:
+            return candidates
+
+        with tracer.span("context_filter") as span:
+            filtered = self.context_filter.filter(query, candidates)
+        self.last_timings["filter_ms"] = span.duration_ms
+        return filtered
 
-    @instrument
-    def generate_completion(self, query: str, context_str: list) -> str:
+    def build_prompt(self, query: str, context_str: list, conversation: str = "") -> str:
+            memories, assembly = self.context_assembler.assemble(query, context_str)
+            self.last_timings["context_tokens"] = assembly["context_tokens"]
+            self.last_timings["context_tokens_saved"] = assembly["tokens_saved"]
+            conversation_block = f"""Earlier in this conversation:
+            <conversation>
+            {conversation}
+            </conversation>
+            """ if conversation else ""
             prompt = f"""You are memex, the user's personal digital memory companion. You have a perfect recollection of everything they've shared with you. You don't just store memories - you understand and recall them with the warmth and understanding of a close friend who was there for each moment.
             
+            {conversation_block}
             User's current question: {query}
 
             Based on this question, here are the most relevant memories and notes they've shared:
             <memories>
-            {context_str}
+            {memories}
             </memories>
 
 
@@ -175,13 +1679,255 @@ class RAG_from_scratch:
 
             Important: Never invent or assume details that weren't shared in their memories. Stick to what they've actually told you.
             """
+            # the template's indentation is only there for readability here
+            prompt = "\n".join(line.strip() for line in prompt.splitlines())
+            self.last_timings["prompt_tokens"] = estimate_tokens(prompt)
+            return prompt
+
+    def generate_completion(self, query: str, context_str: list, conversation: str = "") -> str:
+        prompt = self.build_prompt(query, context_str, conversation)
+        with tracer.span("generate_completion"):
             return Complete("mistral-large2", prompt, session=self.session)
 
-    @instrument
-    def query(self, query: str) -> str:
-        context_str = self.retrieve_context_with_filter(query)
-        print(context_str)
-        return self.generate_completion(query, context_str)
+    def generate_completion_stream(self, query: str, context_str: list, conversation: str = ""):
+        """Yield the answer in chunks as Cortex produces them."""
+        prompt = self.build_prompt(query, context_str, conversation)
+        yield from Complete("mistral-large2", prompt, session=self.session, stream=True)
+
+    def record_streamed_completion(self, query: str, context_str: list, response: str) -> str:
+        """Hands the assembled streamed answer to TruLens so it is recorded like generate_completion."""
+        return response
+
+    def _cached_answer(self, query: str, use_cache: bool = True, question: str = None):
+        """
+        Retrieve candidates for query, the search form of question, and look up a cached answer.
+        Returns (candidates, standard query, answer or None).
+        """
+        standard_query, candidates = self.retrieve_candidates(query)
+        self.conversation.remember_dates(question or query, extract_event_dates(standard_query))
+        if self.answer_cache is None or not use_cache:
+            return candidates, standard_query, None
+        return candidates, standard_query, self.answer_cache.get(standard_query, candidates)
+
+    def _prepare_conversation(self, query: str, history: list):
+        """Returns (query to search with, rendered conversation) for a question asked after history."""
+        if not history:
+            return query, ""
+        return self.conversation.search_query(query, history), self.conversation.render(history)
+
+    def query(self, query: str, history: list = None) -> str:
+        """
+        Answer a question. history is the earlier chat as a list of {"role", "content"} messages;
+        answers that depend on history are not cached.
+        """
+        with tracer.profile("query"), tracer.span("query"):
+            return self._query(query, history)
+
+    def _query(self, query: str, history: list = None) -> str:
+        self.last_timings = {}
+        started = time.perf_counter()
+        search_query, conversation = self._prepare_conversation(query, history)
+        candidates, standard_query, cached = self._cached_answer(search_query, use_cache=not history, question=query)
+        if cached is not None:
+            self.last_timings["cache_hit"] = True
+            return cached
+        context_str = self.retrieve_context_with_filter(search_query, candidates)
+        retrieved = time.perf_counter()
+        response = self.generate_completion(query, context_str, conversation)
+        self.last_timings["retrieve_and_filter_ms"] = (retrieved - started) * 1000
+        self.last_timings["generate_ms"] = (time.perf_counter() - retrieved) * 1000
+        self._after_answer(standard_query, candidates, query, context_str, response, cacheable=not history)
+        return response
+
+    def _after_answer(self, standard_query, candidates, query, context_str, response, cacheable=True):
+        if not response:
+            return
+        if self.answer_cache is not None and cacheable:
+            self.answer_cache.put(standard_query, candidates, response)
+        if self.evaluator is not None:
+            self.evaluator.maybe_submit(query, context_str, response)
+
+    def query_stream(self, query: str, history: list = None):
+        """
+        Streaming variant of query: yields answer chunks as they arrive.
+        The turn itself runs in answer_stream on a worker thread started in the caller's context,
+        so TruLens records retrieval, completion and the full answer as one call.
+        """
+        chunks = queue.Queue()
+
+        def run():
+            try:
+                self.answer_stream(query, history, lambda chunk: chunks.put(("chunk", chunk)))
+            except Exception as e:
+                chunks.put(("error", e))
+            finally:
+                chunks.put(("done", None))
+
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name="memex-answer", daemon=True).start()
+        while True:
+            kind, value = chunks.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+
+    def answer_stream(self, query: str, history: list, on_chunk) -> str:
+        """Answer a question, passing answer chunks to on_chunk as they arrive. Returns the full answer."""
+        # profiled here rather than in the app: cProfile only sees the thread it runs on
+        with tracer.profile("chat_turn"):
+            self.last_timings = {}
+            started = time.perf_counter()
+            search_query, conversation = self._prepare_conversation(query, history)
+            candidates, standard_query, cached = self._cached_answer(search_query, use_cache=not history, question=query)
+            if cached is not None:
+                self.last_timings["cache_hit"] = True
+                on_chunk(cached)
+                return cached
+            context_str = self.retrieve_context_with_filter(search_query, candidates)
+            retrieved = time.perf_counter()
+            self.last_timings["retrieve_and_filter_ms"] = (retrieved - started) * 1000
+
+            chunks = []
+            with tracer.span("generate_completion_stream"):
+                for chunk in self.generate_completion_stream(query, context_str, conversation):
+                    if not chunks:
+                        self.last_timings["first_token_ms"] = (time.perf_counter() - retrieved) * 1000
+                        tracer.record("first_token", time.perf_counter() - retrieved)
+                    chunks.append(chunk)
+                    on_chunk(chunk)
+            self.last_timings["generate_ms"] = (time.perf_counter() - retrieved) * 1000
+            response = self.record_streamed_completion(query, context_str, "".join(chunks))
+            self._after_answer(standard_query, candidates, query, context_str, response, cacheable=not history)
+            return response
+
+def is_transient_error(error: Exception) -> bool:
+    """Best-effort check for Snowflake errors that are worth retrying."""
+    message = f"{type(error).__name__} {error}".lower()
+    return any(marker in message for marker in (
+        "timeout", "timed out", "connection", "network", "temporarily", "throttl",
+        "try again", "503", "504", "operationalerror", "session no longer exists",
+    ))
+
+
+class IngestionQueue:
+    """
+    Write-behind ingestion for the app: memories are accepted into a bounded queue and a
+    background worker standardizes them, writes them in grouped INSERTs and retries
+    transient Snowflake errors with exponential backoff.
+    Each submission gets a ticket whose status moves through queued, standardized,
+    committed, duplicate (skipped as a copy of a stored memory) or failed.
+    One queue can serve every browser session of the app: a memory is written through the
+    RAG_from_scratch it was submitted with (rag by default), so that session sees it right away.
+    With a session pool each batch leases its own session instead of using the RAG's, which the
+    app hands back to the pool when its script run ends.
+    """
+    def __init__(self, rag=None, max_pending: int = 100, batch_size: int = 50,
+                 max_retries: int = 3, backoff_seconds: float = 0.5, max_tracked: int = 1000,
+                 pool: SessionPool = None):
+        self.rag = rag
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_tracked = max_tracked
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._statuses = OrderedDict()
+        self._lock = threading.Lock()
+        self._tickets = itertools.count(1)
+        self._worker = threading.Thread(target=self._run, name="memex-ingestion", daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str, rag=None):
+        """Queue a memory for storage through rag. Returns a ticket id, or None if the queue is full."""
+        rag = rag or self.rag
+        if rag is None:
+            raise ValueError("IngestionQueue.submit needs a rag when the queue has no default")
+        ticket = next(self._tickets)
+        self._set_status(ticket, "queued")
+        try:
+            self._queue.put_nowait((ticket, text, rag))
+        except queue.Full:
+            with self._lock:
+                del self._statuses[ticket]
+            return None
+        return ticket
+
+    def status(self, ticket):
+        with self._lock:
+            return dict(self._statuses.get(ticket, {"status": "unknown", "error": None}))
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _set_status(self, ticket, status, error=None):
+        with self._lock:
+            self._statuses[ticket] = {"status": status, "error": error}
+            self._statuses.move_to_end(ticket)
+            while len(self._statuses) > self.max_tracked:
+                self._statuses.popitem(last=False)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            groups = OrderedDict()
+            for ticket, text, rag in batch:
+                groups.setdefault(id(rag), (rag, []))[1].append((ticket, text))
+            for rag, items in groups.values():
+                self._store(rag, items)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _store(self, rag, items: list):
+        tickets = [ticket for ticket, _ in items]
+        try:
+            standardized = []
+            with self._session() as session:
+                for ticket, text in items:
+                    standardized.append(rag.date_standardizer.standardize_dates(text, session=session))
+                    self._set_status(ticket, "standardized")
+            outcomes = self._write_with_retry(rag, standardized)
+            for ticket, outcome in zip(tickets, outcomes):
+                self._set_status(ticket, "duplicate" if outcome["duplicate_of"] else "committed")
+        except Exception as e:
+            print(f"Error injecting information: {e}")
+            for ticket in tickets:
+                self._set_status(ticket, "failed", str(e))
+
+    def _session(self):
+        """A session leased from the pool for a with block, or None to use the RAG's own session."""
+        return self.pool.leased() if self.pool is not None else nullcontext(None)
+
+    def _write_with_retry(self, rag, standardized: list):
+        for attempt in range(self.max_retries + 1):
+            session = None
+            try:
+                # leased per attempt, so a retry can get the pool's replacement for an expired session
+                with self._session() as session:
+                    return rag.write_memories(standardized, session=session)
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_error(e):
+                    raise
+                if session is not None:
+                    self.pool.check_before_next_lease(session)
+                delay = self.backoff_seconds * (2 ** attempt)
+                print(f"Transient error storing memories, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def join(self):
+        """Block until every queued memory has been committed or failed."""
+        self._queue.join()
+
 
 def main():
     # Creating a rag
@@ -1,8 +1,17 @@
 import snowflake.connector
+import argparse
+import importlib.util
+import itertools
+import json
 import os
+import time
+import uuid
 from dotenv import load_dotenv
+from dedup import DuplicateIndex, content_signature, written_on
 load_dotenv()
 
+EXPORT_COLUMNS = ["ID", "TEXT_CONTENT", "ENTRY_ID", "CHUNK_INDEX", "CREATED_AT", "EVENT_DATES"]
+
 def create_snowflake_connection():
     """Create connection to Snowflake"""
     conn = snowflake.connector.connect(
@@ -13,28 +22,45 @@ def create_snowflake_connection():
     )
     return conn
 
-def execute_setup():
-    """Execute all database setup operations"""
-    conn = create_snowflake_connection()
-    cursor = conn.cursor()
+SEARCH_SERVICE_WITH_ATTRIBUTES = """
+CREATE OR REPLACE CORTEX SEARCH SERVICE MEMEX_SEARCH_SERVICE
+ON TEXT_CONTENT
+ATTRIBUTES EVENT_DATES, CREATED_AT
+WAREHOUSE = COMPUTE_WH
+TARGET_LAG = '1 minute'
+AS (
+    SELECT ID, TEXT_CONTENT, ENTRY_ID, CHUNK_INDEX, CREATED_AT, EVENT_DATES
+    FROM TEXT_PARAGRAPHS_TABLE
+)
+"""
 
-    # Create database and schema
-    setup_commands = [
-        "CREATE DATABASE IF NOT EXISTS MEMEX",
-        "USE DATABASE MEMEX",
-        "CREATE SCHEMA IF NOT EXISTS DATA",
-        
-        # Create table
+def search_service_has_attributes(cursor):
+    """True if MEMEX_SEARCH_SERVICE already exposes the EVENT_DATES attribute"""
+    cursor.execute("SHOW CORTEX SEARCH SERVICES LIKE 'MEMEX_SEARCH_SERVICE'")
+    if not cursor.fetchall():
+        return False
+    cursor.execute("DESCRIBE CORTEX SEARCH SERVICE MEMEX_SEARCH_SERVICE")
+    columns = [column[0].lower() for column in cursor.description]
+    row = cursor.fetchone()
+    if row is None or "attribute_columns" not in columns:
+        return False
+    return "EVENT_DATES" in str(row[columns.index("attribute_columns")] or "").upper()
+
+# Versioned schema migrations: (version, description, statements, check).
+# A migration runs once; check(cursor) returning True means the change is already in place
+# (e.g. on databases set up before migrations were tracked) and it is only recorded.
+MIGRATIONS = [
+    (1, "create memories table", [
         """
-        CREATE OR REPLACE TABLE TEXT_PARAGRAPHS_TABLE (
+        CREATE TABLE IF NOT EXISTS TEXT_PARAGRAPHS_TABLE (
             ID NUMBER AUTOINCREMENT PRIMARY KEY,
             TEXT_CONTENT VARCHAR(16777216)
         )
         """,
-        
-        # Create search service
+    ], None),
+    (2, "create search service", [
         """
-        CREATE OR REPLACE CORTEX SEARCH SERVICE MEMEX_SEARCH_SERVICE
+        CREATE CORTEX SEARCH SERVICE IF NOT EXISTS MEMEX_SEARCH_SERVICE
         ON TEXT_CONTENT
         WAREHOUSE = COMPUTE_WH
         TARGET_LAG = '1 minute'
@@ -42,20 +68,83 @@ def execute_setup():
             SELECT TEXT_CONTENT
             FROM TEXT_PARAGRAPHS_TABLE
         )
+        """,
+    ], None),
+    (3, "add entry, chunk and date metadata columns", [
+        "ALTER TABLE TEXT_PARAGRAPHS_TABLE ADD COLUMN IF NOT EXISTS ENTRY_ID VARCHAR(32)",
+        "ALTER TABLE TEXT_PARAGRAPHS_TABLE ADD COLUMN IF NOT EXISTS CHUNK_INDEX NUMBER DEFAULT 0",
+        "ALTER TABLE TEXT_PARAGRAPHS_TABLE ADD COLUMN IF NOT EXISTS CREATED_AT TIMESTAMP_NTZ",
+        "ALTER TABLE TEXT_PARAGRAPHS_TABLE ADD COLUMN IF NOT EXISTS EVENT_DATES ARRAY",
+    ], None),
+    # The service definition can't be altered in place, so this is the one step that rebuilds the index
+    (4, "expose date metadata as search attributes", [SEARCH_SERVICE_WITH_ATTRIBUTES], search_service_has_attributes),
+    (5, "add content hash and near-duplicate signature columns", [
+        "ALTER TABLE TEXT_PARAGRAPHS_TABLE ADD COLUMN IF NOT EXISTS CONTENT_HASH VARCHAR(64)",
+        "ALTER TABLE TEXT_PARAGRAPHS_TABLE ADD COLUMN IF NOT EXISTS MINHASH VARCHAR(512)",
+    ], None),
+    # Rows deleted from the memories table, so local indexes can drop them without rescanning it
+    (6, "create deleted memories log", [
         """
+        CREATE TABLE IF NOT EXISTS DELETED_MEMORIES (
+            SEQ NUMBER AUTOINCREMENT PRIMARY KEY,
+            ID NUMBER,
+            DELETED_AT TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+        )
+        """,
+    ], None),
+]
+
+def applied_migrations(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SCHEMA_MIGRATIONS (
+            VERSION NUMBER PRIMARY KEY,
+            DESCRIPTION VARCHAR,
+            APPLIED_AT TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+        )
+    """)
+    cursor.execute("SELECT VERSION FROM SCHEMA_MIGRATIONS")
+    return {row[0] for row in cursor.fetchall()}
+
+def run_migrations(conn, cursor):
+    """Apply pending migrations in order. Already applied versions are never re-run."""
+    applied = applied_migrations(cursor)
+    pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+    if not pending:
+        print("Schema is up to date, nothing to migrate.")
+        return []
+
+    for version, description, statements, check in pending:
+        if check is not None and check(cursor):
+            print(f"Migration {version} ({description}) already in place, recording it.")
+        else:
+            print(f"Applying migration {version}: {description}")
+            for statement in statements:
+                cursor.execute(statement)
+        cursor.execute(
+            "INSERT INTO SCHEMA_MIGRATIONS (VERSION, DESCRIPTION) VALUES (%s, %s)",
+            (version, description),
+        )
+        conn.commit()
+    return [migration[0] for migration in pending]
+
+def execute_setup():
+    """Create the database and schema if needed and apply pending schema migrations"""
+    conn = create_snowflake_connection()
+    cursor = conn.cursor()
+
+    # Create database and schema
+    setup_commands = [
+        "CREATE DATABASE IF NOT EXISTS MEMEX",
+        "USE DATABASE MEMEX",
+        "CREATE SCHEMA IF NOT EXISTS DATA",
+        "USE SCHEMA DATA",
     ]
 
     try:
-        # Execute all setup commands
         for command in setup_commands:
             cursor.execute(command)
-            conn.commit()
-        # Query and print results
-        cursor.execute("SELECT * FROM TEXT_PARAGRAPHS_TABLE")
-        results = cursor.fetchall()
-        print("\nQuery Results:")
-        for row in results:
-            print(row)
+        run_migrations(conn, cursor)
+        print_summary(cursor)
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -64,7 +153,24 @@ def execute_setup():
         cursor.close()
         conn.close()
 
-def info_check():
+def print_summary(cursor, preview_rows=0):
+    """Print row count, ID range and stored text size, plus optionally the newest rows"""
+    cursor.execute("""
+        SELECT COUNT(*), MIN(ID), MAX(ID), COALESCE(SUM(LENGTH(TEXT_CONTENT)), 0)
+        FROM TEXT_PARAGRAPHS_TABLE
+    """)
+    count, min_id, max_id, text_chars = cursor.fetchone()
+    print(f"\nTEXT_PARAGRAPHS_TABLE: {count} rows, IDs {min_id}..{max_id}, {text_chars} characters of text")
+    if preview_rows:
+        cursor.execute(
+            f"SELECT {', '.join(EXPORT_COLUMNS)} FROM TEXT_PARAGRAPHS_TABLE ORDER BY ID DESC LIMIT %s",
+            (preview_rows,),
+        )
+        print(f"\nNewest {preview_rows} rows:")
+        for row in cursor.fetchall():
+            print(row)
+
+def info_check(preview_rows=10):
     """check the talbes and data in the database"""
 
     conn = create_snowflake_connection()
@@ -72,12 +178,7 @@ def info_check():
     try:
         cursor.execute("USE DATABASE MEMEX")
         cursor.execute("USE SCHEMA DATA")
-        # Query and print results
-        cursor.execute("SELECT * FROM TEXT_PARAGRAPHS_TABLE")
-        results = cursor.fetchall()
-        print("\nQuery Results:")
-        for row in results:
-            print(row)
+        print_summary(cursor, preview_rows)
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -86,6 +187,230 @@ def info_check():
         cursor.close()
         conn.close()
 
+def iter_batches(cursor, batch_size):
+    """Yield lists of row dicts, using Arrow result batches when pyarrow is installed"""
+    if importlib.util.find_spec("pyarrow") is not None:
+        batches = None
+        try:
+            # Arrow support is decided when the first batch is fetched; fall back only before any rows are read
+            batches = cursor.fetch_arrow_batches()
+            first = next(batches, None)
+        except (snowflake.connector.errors.NotSupportedError,
+                snowflake.connector.errors.ProgrammingError,
+                snowflake.connector.errors.MissingDependencyError,
+                ImportError):
+            batches = None
+        if batches is not None:
+            if first is not None:
+                yield first.to_pylist()
+            for batch in batches:
+                yield batch.to_pylist()
+            return
+    columns = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield [dict(zip(columns, row)) for row in rows]
+
+def last_exported_id(path):
+    """ID of the last complete record in an existing JSONL export, for resuming"""
+    if not os.path.exists(path):
+        return None
+    last_line = None
+    with open(path, "rb") as f:
+        for line in f:
+            # an interrupted export can end in a partial line without a newline
+            if line.strip() and line.endswith(b"\n"):
+                last_line = line
+    return json.loads(last_line)["ID"] if last_line else None
+
+def drop_partial_line(path):
+    """Cut an interrupted JSONL export back to its last complete line, so resumed rows start on a new line"""
+    if not os.path.exists(path):
+        return
+    end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.endswith(b"\n"):
+                end += len(line)
+            else:
+                break
+    if end < os.path.getsize(path):
+        with open(path, "rb+") as f:
+            f.truncate(end)
+
+def normalize_row(row):
+    if isinstance(row.get("EVENT_DATES"), str):
+        row["EVENT_DATES"] = json.loads(row["EVENT_DATES"])
+    return row
+
+def export_memories(path, fmt="jsonl", after_id=None, resume=False, batch_size=10000):
+    """
+    Stream TEXT_PARAGRAPHS_TABLE to a JSONL or Parquet file in ID order, one result batch at a time.
+    With resume, a JSONL export continues after the last ID already in the file.
+    """
+    if resume:
+        if fmt != "jsonl":
+            raise ValueError("resume needs a JSONL export; pass --after-id for Parquet")
+        drop_partial_line(path)
+        after_id = last_exported_id(path)
+        if after_id is not None:
+            print(f"Resuming export after ID {after_id}")
+
+    conn = create_snowflake_connection()
+    cursor = conn.cursor()
+    writer = None
+    rows = 0
+    started = time.perf_counter()
+    try:
+        cursor.execute("USE DATABASE MEMEX")
+        cursor.execute("USE SCHEMA DATA")
+        cursor.execute(
+            f"SELECT {', '.join(EXPORT_COLUMNS)} FROM TEXT_PARAGRAPHS_TABLE WHERE ID > %s ORDER BY ID",
+            (after_id if after_id is not None else -1,),
+        )
+
+        if fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([
+                ("ID", pa.int64()),
+                ("TEXT_CONTENT", pa.string()),
+                ("ENTRY_ID", pa.string()),
+                ("CHUNK_INDEX", pa.int64()),
+                ("CREATED_AT", pa.timestamp("us")),
+                ("EVENT_DATES", pa.list_(pa.string())),
+            ])
+            writer = pq.ParquetWriter(path, schema)
+            for batch in iter_batches(cursor, batch_size):
+                batch = [normalize_row(row) for row in batch]
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                rows += len(batch)
+                print(f"  {rows} rows exported", end="\r")
+        else:
+            mode = "a" if resume else "w"
+            with open(path, mode, encoding="utf-8") as f:
+                for batch in iter_batches(cursor, batch_size):
+                    for row in batch:
+                        f.write(json.dumps(normalize_row(row), default=str) + "\n")
+                    rows += len(batch)
+                    print(f"  {rows} rows exported", end="\r")
+
+    finally:
+        if writer is not None:
+            writer.close()
+        cursor.close()
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    print(f"\nExported {rows} rows to {path} ({size / 1e6:.1f} MB on disk) in {elapsed:.1f}s, "
+          f"{rows / elapsed if elapsed else 0:.0f} rows/s")
+    return rows
+
+def dedupe_memories(dry_run=False, threshold=0.85, batch_size=10000):
+    """
+    One-off backfill: store content hashes and MinHash signatures for every memory and delete
+    later copies of exact and near duplicate memories written on the same day, keeping the oldest one.
+    Memories stored before ENTRY_ID existed get an ENTRY_ID of their own.
+    """
+    conn = create_snowflake_connection()
+    cursor = conn.cursor()
+    writer = conn.cursor()
+    index = DuplicateIndex(threshold)
+    pending = []
+    entries = duplicates = 0
+    started = time.perf_counter()
+
+    def flush():
+        if pending and not dry_run:
+            writer.executemany("INSERT INTO DEDUP_SIGNATURES VALUES (%s, %s, %s, %s, %s)", pending)
+        pending.clear()
+
+    try:
+        cursor.execute("USE DATABASE MEMEX")
+        cursor.execute("USE SCHEMA DATA")
+        if not dry_run:
+            writer.execute("""
+                CREATE OR REPLACE TEMPORARY TABLE DEDUP_SIGNATURES (
+                    ID NUMBER, ENTRY_ID VARCHAR(32), CONTENT_HASH VARCHAR(64), MINHASH VARCHAR(512), DUPLICATE BOOLEAN
+                )
+            """)
+        # chunks of an entry next to each other, entries oldest first
+        cursor.execute("""
+            SELECT ID, ENTRY_ID, TEXT_CONTENT, CREATED_AT FROM TEXT_PARAGRAPHS_TABLE
+            ORDER BY MIN(ID) OVER (PARTITION BY COALESCE(ENTRY_ID, TO_VARCHAR(ID))), CHUNK_INDEX, ID
+        """)
+        rows = (row for batch in iter_batches(cursor, batch_size) for row in batch)
+        for _, group in itertools.groupby(rows, key=lambda row: row["ENTRY_ID"] or f"row-{row['ID']}"):
+            group = list(group)
+            entry_id = group[0]["ENTRY_ID"] or uuid.uuid4().hex
+            content_hash, minhash = content_signature(" ".join(row["TEXT_CONTENT"] or "" for row in group))
+            day = written_on(group[0]["CREATED_AT"])
+            match = index.find(content_hash, minhash, day)
+            if match:
+                duplicates += 1
+                if dry_run and duplicates <= 10:
+                    print(f"  {match[0]} duplicate of entry {match[1]}: {group[0]['TEXT_CONTENT'][:80]!r}")
+            else:
+                index.add(entry_id, content_hash, minhash, day)
+            pending.extend((row["ID"], entry_id, content_hash, minhash, match is not None) for row in group)
+            entries += 1
+            if len(pending) >= batch_size:
+                flush()
+        flush()
+
+        if not dry_run:
+            writer.execute("""
+                UPDATE TEXT_PARAGRAPHS_TABLE T
+                SET ENTRY_ID = S.ENTRY_ID, CONTENT_HASH = S.CONTENT_HASH, MINHASH = S.MINHASH
+                FROM DEDUP_SIGNATURES S
+                WHERE T.ID = S.ID AND NOT S.DUPLICATE
+            """)
+            writer.execute("INSERT INTO DELETED_MEMORIES (ID) SELECT ID FROM DEDUP_SIGNATURES WHERE DUPLICATE")
+            writer.execute("""
+                DELETE FROM TEXT_PARAGRAPHS_TABLE
+                USING DEDUP_SIGNATURES S
+                WHERE TEXT_PARAGRAPHS_TABLE.ID = S.ID AND S.DUPLICATE
+            """)
+            conn.commit()
+
+    finally:
+        writer.close()
+        cursor.close()
+        conn.close()
+
+    action = "would remove" if dry_run else "removed"
+    print(f"Checked {entries} memories in {time.perf_counter() - started:.1f}s, {action} {duplicates} duplicates")
+    return duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description="memex Snowflake setup and maintenance")
+    subcommands = parser.add_subparsers(dest="command")
+    subcommands.add_parser("setup", help="create the database if needed and apply schema migrations (default)")
+    info = subcommands.add_parser("info", help="print table size and the newest rows")
+    info.add_argument("--rows", type=int, default=10, help="number of newest rows to show")
+    export = subcommands.add_parser("export", help="stream the memories table to a file")
+    export.add_argument("path")
+    export.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    export.add_argument("--after-id", type=int, help="only export rows with a larger ID")
+    export.add_argument("--resume", action="store_true", help="continue an interrupted JSONL export")
+    export.add_argument("--batch-size", type=int, default=10000, help="rows per fetch without Arrow")
+    dedupe = subcommands.add_parser("dedupe", help="backfill duplicate signatures and remove duplicate memories")
+    dedupe.add_argument("--dry-run", action="store_true", help="only report the duplicates that would be removed")
+    dedupe.add_argument("--threshold", type=float, default=0.85, help="word similarity for near duplicates")
+    dedupe.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.command == "info":
+        info_check(args.rows)
+    elif args.command == "export":
+        export_memories(args.path, args.format, args.after_id, args.resume, args.batch_size)
+    elif args.command == "dedupe":
+        dedupe_memories(args.dry_run, args.threshold, args.batch_size)
+    else:
+        execute_setup()
+
 if __name__ == "__main__":
-    execute_setup()
-    #info_check()
\ No newline at end of file
+    main()
@@ -0,0 +1,62 @@
+import pytest
+
+from rag import ConversationMemory, DateStandardizer, extract_event_dates
+from tests.test_date_resolver import CURRENT_DATE
+
+HISTORY = [
+    {"role": "user", "content": "What did I do yesterday at the beach with Anna?"},
+    {"role": "assistant", "content": "You went swimming with Anna."},
+]
+
+FOLLOW_UP_CASES = [
+    "and the day after?",
+    "what about her?",
+    "where was that?",
+    "who else was there?",
+    "the next day?",
+]
+
+STANDALONE_CASES = [
+    "What did I eat for lunch on Monday this week?",
+    "Is it true that I met Bob in Paris last month?",
+    "Where did Priya say she is moving to?",
+    "what did I do this morning before work",
+]
+
+
+@pytest.mark.parametrize("query", FOLLOW_UP_CASES)
+def test_follow_up_is_searched_with_previous_topic(query):
+    assert ConversationMemory(None).search_query(query, HISTORY) == f"beach Anna {query}"
+
+
+@pytest.mark.parametrize("query", STANDALONE_CASES)
+def test_standalone_question_is_searched_alone(query):
+    assert ConversationMemory(None).search_query(query, HISTORY) == query
+
+
+def test_previous_dates_do_not_restrict_follow_up():
+    history = [{"role": "user", "content": "What did I do on Friday, October 16, 2026 and 2025-12-25?"}]
+    query = ConversationMemory(None).search_query("and tomorrow?", history)
+    standardized = DateStandardizer(None).resolve_locally(query, CURRENT_DATE, is_query=True)
+    assert extract_event_dates(standardized) == ["2026-10-19"]
+
+
+@pytest.mark.parametrize("follow_up, expected", [
+    ("and the day after?", ["2026-10-18"]),
+    ("what about the day before?", ["2026-10-16"]),
+    ("and the next day", ["2026-10-18"]),
+])
+def test_relative_follow_up_resolves_against_previous_dates(follow_up, expected):
+    conversation = ConversationMemory(None)
+    conversation.remember_dates(HISTORY[0]["content"], ["2026-10-17"])
+    query = conversation.search_query(follow_up, HISTORY)
+    standardized = DateStandardizer(None).resolve_locally(query, CURRENT_DATE, is_query=True)
+    assert extract_event_dates(standardized) == expected
+
+
+def test_week_after_follows_previous_week():
+    conversation = ConversationMemory(None)
+    conversation.remember_dates("who did I meet last week", [f"2026-10-{day:02d}" for day in range(5, 12)])
+    query = conversation.search_query("and the week after?", [{"role": "user", "content": "who did I meet last week"}])
+    standardized = DateStandardizer(None).resolve_locally(query, CURRENT_DATE, is_query=True)
+    assert extract_event_dates(standardized) == [f"2026-10-{day:02d}" for day in range(12, 19)]
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import pytest
+
+from rag import DateStandardizer, extract_event_dates
+
+# Sunday, October 18, 2026
+NOW = datetime(2026, 10, 18, 9, 30)
+CURRENT_DATE = {
+    "datetime": NOW,
+    "date": NOW.strftime("%Y-%m-%d"),
+    "day": NOW.strftime("%A"),
+    "full_date": NOW.strftime("%A, %B %d, %Y"),
+    "time": NOW.strftime("%I:%M %p"),
+}
+
+QUERY_CASES = [
+    ("what did I do yesterday?", "what did I do on Saturday, October 17, 2026?"),
+    ("what happened on the day before yesterday", "what happened on Friday, October 16, 2026"),
+    ("plans for tomorrow", "plans for Monday, October 19, 2026"),
+    ("what am I doing next friday", "what am I doing on Friday, October 23, 2026"),
+    ("what did I do last monday", "what did I do on Monday, October 12, 2026"),
+    ("what am I doing this sunday", "what am I doing on Sunday, October 18, 2026"),
+    ("who did I meet last week", "who did I meet the week of Monday, October 05, 2026"),
+    ("how was last month", "how was in September 2026"),
+    ("what did I do three days ago", "what did I do on Thursday, October 15, 2026"),
+    ("where will I be two weeks from now", "where will I be on Sunday, November 01, 2026"),
+    ("how was my christmas last year", "how was my christmas in 2025"),
+    ("any plans for next May", "any plans for May 2027"),
+    ("how was last christmas", "how was on Thursday, December 25, 2025"),
+    ("who is moving to Berlin?", "who is moving to Berlin?"),
+]
+
+# None: the rules must leave these to the LLM
+AMBIGUOUS_CASES = [
+    "she said this may help",
+    "this march was brutal",
+    "I have a dentist appointment this Friday",
+    "this Monday I start my new job",
+    "what did I do a year ago today",
+    "I did it in a day",
+    "I'm leaving in two weeks",
+    "what did I do last weekend",
+    "anything planned for next summer",
+    "what did I do recently",
+    "see you on monday",
+]
+
+
+@pytest.mark.parametrize("text, expected", QUERY_CASES)
+def test_resolves_queries(text, expected):
+    assert DateStandardizer(None).resolve_locally(text, CURRENT_DATE, is_query=True) == expected
+
+
+@pytest.mark.parametrize("text", AMBIGUOUS_CASES)
+def test_leaves_ambiguous_text_to_llm(text):
+    assert DateStandardizer(None).resolve_locally(text, CURRENT_DATE, is_query=True) is None
+    assert DateStandardizer(None).resolve_locally(text, CURRENT_DATE) is None
+
+
+def test_annotates_memories_in_place():
+    resolved = DateStandardizer(None).resolve_locally("Yesterday I went hiking", CURRENT_DATE)
+    assert resolved == (
+        "Yesterday(On Saturday, October 17, 2026) I went hiking\n"
+        "(conversation happened on Sunday, October 18, 2026 at 09:30 AM)"
+    )
+    assert extract_event_dates(resolved) == ["2026-10-17"]
+
+
+def test_memory_without_dates_is_unchanged():
+    text = "I think this may be the best day"
+    assert DateStandardizer(None).resolve_locally(text, CURRENT_DATE) is None
+    text = "Lunch with Priya, she is moving to Berlin"
+    assert DateStandardizer(None).resolve_locally(text, CURRENT_DATE).startswith(text + "\n(conversation happened on")
+
+
+def test_week_of_expands_to_seven_days():
+    assert extract_event_dates("the week of Monday, October 05, 2026") == [
+        f"2026-10-{day:02d}" for day in range(5, 12)
+    ]
@@ -0,0 +1,33 @@
+import pytest
+
+from dedup import DuplicateIndex, content_signature, written_on
+
+STORED = "Went to the gym with Sam.\n(conversation happened on Monday, October 12, 2026 at 07:30 PM)"
+
+CASES = [
+    # (text, written on, expected match)
+    ("Went to the gym with Sam.\n(conversation happened on Monday, October 12, 2026 at 09:10 PM)",
+     "2026-10-12", "exact"),
+    ("went to the gym with Sam!", "2026-10-12", "exact"),
+    ("Went to the gym with Sam and Priya after work, then we had a quick dinner downtown and walked home.",
+     "2026-10-12", None),
+    ("Went to the gym with Sam.\n(conversation happened on Wednesday, October 14, 2026 at 07:30 PM)",
+     "2026-10-14", None),
+]
+
+
+@pytest.mark.parametrize("text, day, expected", CASES)
+def test_duplicates_are_only_matched_on_the_same_day(text, day, expected):
+    index = DuplicateIndex()
+    index.add("e1", *content_signature(STORED), written_on("2026-10-12 19:30:00"))
+    match = index.find(*content_signature(text), day)
+    assert (match[0] if match else None) == expected
+
+
+def test_near_duplicate_on_another_day_is_kept():
+    text = "I went to the gym with Sam today and we did legs and back and some cardio after"
+    edited = "I went to the gym with Sam today and we did legs and back and some cardio afterwards"
+    index = DuplicateIndex()
+    index.add("e1", *content_signature(text), "2026-10-12")
+    assert index.find(*content_signature(edited), "2026-10-12") == ("near", "e1")
+    assert index.find(*content_signature(edited), "2026-10-19") is None
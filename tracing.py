@@ -0,0 +1,153 @@
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+class Span:
+    """Timing of one traced block. duration_ms is set when the block exits."""
+    __slots__ = ("name", "started", "duration_ms", "error")
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.error = False
+
+
+class Tracer:
+    """
+    Aggregates span durations into per-stage histograms in memory.
+    Recording a span is a perf_counter pair and a locked counter update, so it is cheap enough
+    to leave on for every request. Histograms can be exported as JSON or Prometheus text.
+    Sampled cProfile runs are written to profile_dir when profile_sample_rate is above zero.
+    """
+    def __init__(self, metrics_file=None, export_interval_seconds=30.0, profile_sample_rate=0.0, profile_dir="profiles"):
+        self.metrics_file = metrics_file
+        self.export_interval_seconds = export_interval_seconds
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._last_export = time.monotonic()
+
+    @contextmanager
+    def span(self, name):
+        span = Span(name)
+        try:
+            yield span
+        except Exception:
+            span.error = True
+            raise
+        finally:
+            span.duration_ms = (time.perf_counter() - span.started) * 1000
+            self.record(name, span.duration_ms / 1000, span.error)
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = {
+                    "count": 0, "sum": 0.0, "errors": 0, "buckets": [0] * (len(BUCKETS) + 1)
+                }
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["errors"] += int(error)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+            else:
+                histogram["buckets"][-1] += 1
+        self.maybe_export()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {**histogram, "buckets": list(histogram["buckets"])}
+                for name, histogram in self._histograms.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP memex_stage_duration_seconds Time spent in each memex pipeline stage.",
+            "# TYPE memex_stage_duration_seconds histogram",
+        ]
+        errors = []
+        for name, histogram in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ["+Inf"], histogram["buckets"]):
+                cumulative += count
+                lines.append(f'memex_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'memex_stage_duration_seconds_sum{{stage="{name}"}} {histogram["sum"]}')
+            lines.append(f'memex_stage_duration_seconds_count{{stage="{name}"}} {histogram["count"]}')
+            errors.append(f'memex_stage_errors_total{{stage="{name}"}} {histogram["errors"]}')
+        lines += ["# HELP memex_stage_errors_total Spans that ended with an exception.",
+                  "# TYPE memex_stage_errors_total counter"] + errors
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        return json.dumps({"buckets": BUCKETS, "stages": self.snapshot()}, indent=2)
+
+    def export(self, path=None):
+        """Write histograms to path (Prometheus text for .prom/.txt files, JSON otherwise)."""
+        path = path or self.metrics_file
+        if not path:
+            return
+        content = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self._last_export = time.monotonic()
+
+    def maybe_export(self):
+        """Export to metrics_file if one is configured and the export interval has passed."""
+        if self.metrics_file and time.monotonic() - self._last_export >= self.export_interval_seconds:
+            self._last_export = time.monotonic()
+            try:
+                self.export()
+            except OSError as e:
+                print(f"Error exporting metrics: {e}")
+
+    @contextmanager
+    def profile(self, name):
+        """Run the block under cProfile for a sampled fraction of calls and dump the stats."""
+        if self.profile_sample_rate <= 0 or random.random() >= self.profile_sample_rate:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already active on this thread
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            filename = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}.prof"
+            profiler.dump_stats(os.path.join(self.profile_dir, filename))
+
+
+tracer = Tracer(
+    metrics_file=os.getenv("MEMEX_METRICS_FILE"),
+    export_interval_seconds=float(os.getenv("MEMEX_METRICS_EXPORT_INTERVAL", "30")),
+    profile_sample_rate=float(os.getenv("MEMEX_PROFILE_SAMPLE_RATE", "0")),
+    profile_dir=os.getenv("MEMEX_PROFILE_DIR", "profiles"),
+)